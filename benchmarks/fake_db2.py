@@ -0,0 +1,135 @@
+"""A stand-in for an IBM i DB2 connection that generates its rows on the fly,
+so the tap can be benchmarked without a real system. Install it by patching
+tap_db2.common.connection with FakeDB2(...).connect."""
+import itertools
+import re
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+# The catalog row (data_type, character_maximum_length, numeric_precision,
+# numeric_scale, ccsid) and a value generator for each supported column type.
+COLUMN_TYPES = {
+    "integer": (("INTEGER", None, 10, 0, None),
+                lambda i: i),
+    "decimal": (("DECIMAL", None, 15, 2, None),
+                lambda i: Decimal(i * 37 % 10 ** 13) / 100),
+    "timestmp": (("TIMESTMP", None, None, None, None),
+                 lambda i: datetime(2020, 1, 1) + timedelta(seconds=i,
+                                                            microseconds=i)),
+    "date": (("DATE", None, None, None, None),
+             lambda i: date(2020, 1, 1) + timedelta(days=i % 3650)),
+    "varchar": (("VARCHAR", 40, None, None, 37),
+                lambda i: "value {:>10} of a varchar column".format(i)),
+}
+
+
+def parse_column_mix(mix):
+    """Turns a spec like "decimal:4,varchar:2" into a list of column types,
+    preceded by an integer ID column that acts as the primary key."""
+    types = ["integer"]
+    for part in mix.split(","):
+        name, _, count = part.strip().partition(":")
+        if name not in COLUMN_TYPES:
+            raise ValueError("Unknown column type {}".format(name))
+        types += [name] * int(count or 1)
+    return types
+
+
+def column_names(types):
+    return ["ID"] + ["{}_{}".format(t.upper(), i)
+                     for i, t in enumerate(types[1:], 1)]
+
+
+class FakeDB2(object):
+    """Describes the fake system: `tables` tables in schema BENCH, each with
+    the given column types, and `rows` rows in every table."""
+    def __init__(self, rows=100000, types=None, tables=1):
+        self.rows = rows
+        self.types = types or parse_column_mix("varchar:1")
+        self.names = column_names(self.types)
+        self.tables = ["TABLE_{}".format(i) for i in range(tables)]
+
+    def connect(self, config):
+        return FakeConnection(self)
+
+    def table_rows(self):
+        return (("BENCH", t, "T") for t in self.tables)
+
+    def column_rows(self):
+        for table in self.tables:
+            for name, type_ in zip(self.names, self.types):
+                yield ("BENCH", table, name) + COLUMN_TYPES[type_][0]
+
+    def key_rows(self):
+        return (("BENCH", t, "ID", 1) for t in self.tables)
+
+    def catalog_rows(self):
+        for table in self.tables:
+            for name, type_ in zip(self.names, self.types):
+                yield (("BENCH", table, "T", name) + COLUMN_TYPES[type_][0]
+                       + (1 if name == "ID" else None,))
+
+    def data_rows(self, start, limit):
+        generators = [COLUMN_TYPES[t][1] for t in self.types]
+        stop = self.rows if limit is None else min(self.rows, start + limit)
+        for i in range(start, stop):
+            yield tuple(generate(i) for generate in generators)
+
+
+class FakeConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+    def __init__(self, db):
+        self.db = db
+        self.arraysize = 1
+        self.rows = iter(())
+
+    def execute(self, sql, params=()):
+        if "FROM qsys2.syscolumns C" in sql:
+            self.rows = self.db.catalog_rows()
+        elif "qsys2.systables" in sql:
+            self.rows = self.db.table_rows()
+        elif "qsys2.syscolumns" in sql:
+            self.rows = self.db.column_rows()
+        elif "qsys2.syskeycst" in sql:
+            self.rows = self.db.key_rows()
+        elif "sysdummy1" in sql:
+            self.rows = iter([(1,)])
+        else:
+            self.rows = self._select(sql, params)
+
+    def _select(self, sql, params):
+        # Data queries are either a plain SELECT or a page of a keyset
+        # sync on ID, in which case the last parameter is the last ID read.
+        start = 0
+        if params and re.search(r'"ID" > \?', sql):
+            start = params[-1] + 1
+        limit = re.search(r"FETCH FIRST (\d+) ROWS", sql)
+        return self.db.data_rows(start, int(limit.group(1)) if limit else None)
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self.rows, size or self.arraysize))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def close(self):
+        pass
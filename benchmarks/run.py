@@ -0,0 +1,197 @@
+"""Measures the tap's throughput against a generated fake DB2 system.
+
+    python -m benchmarks.run                      # run every scenario
+    python -m benchmarks.run --only sync-wide     # run some of them
+    python -m benchmarks.run --save before        # keep the results
+    python -m benchmarks.run --compare before     # check for regressions
+
+Each scenario runs in a fresh process so that its peak RSS is its own.
+Saved results are written to benchmarks/results/<name>.json."""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from time import perf_counter
+from unittest import mock
+
+from tap_db2 import discovery, encoder, output, sync
+from .fake_db2 import FakeDB2, parse_column_mix
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# For each metric, whether a higher value is better.
+METRICS = OrderedDict([
+    ("rows_per_sec", True),
+    ("bytes_per_sec", True),
+    ("seconds", False),
+    ("peak_rss_mb", False),
+    ("peak_traced_mb", False),
+])
+
+SCENARIOS = OrderedDict([
+    ("sync-narrow", {"kind": "sync", "rows": 200000,
+                     "columns": "varchar:1"}),
+    ("sync-mixed", {"kind": "sync", "rows": 100000,
+                    "columns": "decimal:4,timestmp:2,date:2,varchar:4"}),
+    ("sync-wide", {"kind": "sync", "rows": 10000,
+                   "columns": "decimal:100,timestmp:50,date:20,varchar:30"}),
+    ("sync-wide-fast", {"kind": "sync", "rows": 10000,
+                        "columns": "decimal:100,timestmp:50,date:20,varchar:30",
+                        "config": {"fast_output": True}}),
+    ("sync-wide-workers", {"kind": "sync", "rows": 10000,
+                           "columns": "decimal:100,timestmp:50,date:20,"
+                                      "varchar:30",
+                           "config": {"fast_output": True,
+                                      "encode_workers": 4}}),
+    ("discover", {"kind": "discover", "tables": 2000,
+                  "columns": "decimal:5,timestmp:5,date:5,varchar:5"}),
+    ("discover-streaming", {"kind": "discover", "tables": 2000,
+                            "columns": "decimal:5,timestmp:5,date:5,varchar:5",
+                            "config": {"streaming_discovery": True}}),
+])
+
+
+class _CountingSink(object):
+    """Stands in for stdout, only counting what is written to it."""
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+
+    def flush(self):
+        pass
+
+
+def _config(scenario):
+    config = {"host": "bench", "user": "bench", "password": "bench"}
+    config.update(scenario.get("config", {}))
+    return config
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak / 1024
+
+
+def _bench_sync(scenario):
+    db = FakeDB2(rows=scenario["rows"],
+                 types=parse_column_mix(scenario["columns"]))
+    config = _config(scenario)
+    with mock.patch("tap_db2.common.connection", db.connect):
+        entry = discovery.discover(config).streams[0]
+        sink = _CountingSink()
+        output.configure(config, out=sink)
+        start = perf_counter()
+        sync._sync_table(config, {}, entry)
+        elapsed = perf_counter() - start
+        encoder.shutdown()
+    return {"rows_per_sec": db.rows / elapsed,
+            "bytes_per_sec": sink.bytes / elapsed,
+            "seconds": elapsed,
+            "peak_rss_mb": _peak_rss_mb()}
+
+
+def _bench_discover(scenario):
+    db = FakeDB2(tables=scenario["tables"],
+                 types=parse_column_mix(scenario["columns"]))
+    config = _config(scenario)
+    with mock.patch("tap_db2.common.connection", db.connect):
+        tracemalloc.start()
+        start = perf_counter()
+        if config.get("streaming_discovery"):
+            discovery.dump_streaming(config, _CountingSink())
+        else:
+            json.dumps(discovery.discover(config).to_dict())
+        elapsed = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"seconds": elapsed,
+            "peak_traced_mb": peak / 1024 / 1024,
+            "peak_rss_mb": _peak_rss_mb()}
+
+
+def run_scenario(name, scale=1.0):
+    scenario = dict(SCENARIOS[name])
+    for key in ("rows", "tables"):
+        if key in scenario:
+            scenario[key] = max(1, int(scenario[key] * scale))
+    if scenario["kind"] == "sync":
+        return _bench_sync(scenario)
+    return _bench_discover(scenario)
+
+
+def _results_path(name):
+    return os.path.join(RESULTS_DIR, "{}.json".format(name))
+
+
+def _compare(baseline, results, tolerance):
+    """Prints how each metric changed against the baseline and returns the
+    names of the metrics that got worse by more than tolerance."""
+    regressions = []
+    for name, metrics in results.items():
+        old_metrics = baseline.get(name, {})
+        for metric, higher_is_better in METRICS.items():
+            if metric not in metrics or metric not in old_metrics:
+                continue
+            old, new = old_metrics[metric], metrics[metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions.append("{} {}".format(name, metric))
+            print("{:<20} {:<15} {:>14.2f} -> {:>14.2f} ({:+.1%}){}".format(
+                name, metric, old, new, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=list(SCENARIOS),
+                        help="Scenarios to run (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiplies the row and table counts")
+    parser.add_argument("--save", metavar="NAME",
+                        help="Save the results as NAME")
+    parser.add_argument("--compare", metavar="NAME",
+                        help="Compare the results to those saved as NAME")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative slowdown when comparing")
+    args = parser.parse_args()
+
+    results = OrderedDict()
+    for name in args.only or SCENARIOS:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[name] = executor.submit(run_scenario, name,
+                                            args.scale).result()
+        print("{:<20} {}".format(name, ", ".join(
+            "{}={:.2f}".format(k, v) for k, v in results[name].items())))
+
+    if args.save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(_results_path(args.save), "w") as f:
+            json.dump({"created": datetime.utcnow().isoformat(),
+                       "python": platform.python_version(),
+                       "scale": args.scale,
+                       "results": results}, f, indent=2)
+    if args.compare:
+        with open(_results_path(args.compare)) as f:
+            baseline = json.load(f)["results"]
+        regressions = _compare(baseline, results, args.tolerance)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,15 @@ setup(
         "singer-python==5.0.4",
         "pyodbc>4,<5",
     ],
+    extras_require={
+        "fast": ["python-rapidjson"],
+        "export": ["pyarrow>=3"],
+        "zstd": ["zstandard"],
+    },
     entry_points="""
     [console_scripts]
     tap-db2=tap_db2:main
+    tap-db2-server=tap_db2.server:main
     """,
     packages=["tap_db2", "tap_db2.discovery"],
     include_package_data=True,
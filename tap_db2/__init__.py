@@ -2,7 +2,7 @@
 import singer
 from singer import utils
 from singer.catalog import Catalog
-from . import resolve, sync, discovery, common
+from . import resolve, sync, discovery, common, output, export, compression
 
 REQUIRED_CONFIG_KEYS = ["host", "user", "password"]
 LOGGER = singer.get_logger()
@@ -11,14 +11,23 @@ LOGGER = singer.get_logger()
 def do_sync(args, input_catalog):
     state = resolve.build_state(args.state, input_catalog)
     catalog = resolve.resolve_catalog(input_catalog, input_catalog, state)
-    sync.sync(args.config, state, catalog)
+    export.check_config(args.config)
+    compression.check_config(args.config)
+    output.configure(args.config)
+    try:
+        sync.sync(args.config, state, catalog)
+    finally:
+        output.close()
 
 
 def main_impl():
     args = utils.parse_args(REQUIRED_CONFIG_KEYS)
     common.setup_port_configuration(args.config)
     if args.discover:
-        discovery.discover(args.config).dump()
+        if args.config.get("streaming_discovery"):
+            discovery.dump_streaming(args.config)
+        else:
+            discovery.discover(args.config).dump()
         print()
     elif args.catalog:
         do_sync(args, args.catalog)
@@ -34,3 +43,5 @@ def main():
     except Exception as exc:
         LOGGER.critical("unknown top-level tap exception", exc_info=exc)
         raise
+    finally:
+        common.close_pools()
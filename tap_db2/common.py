@@ -1,12 +1,22 @@
 import os
 import re
 import shutil
+import threading
 import configparser
+from time import time as time_
 import pyodbc
 import backoff
+import singer
 
 # pylint: disable=no-member
 
+LOGGER = singer.get_logger()
+
+DEFAULT_MAX_IDLE_CONNECTIONS = 8
+# Connections that have sat in the pool for longer than this are checked
+# with a trivial query before being handed out again.
+VALIDATE_AFTER_IDLE_SECONDS = 30
+
 def _write_userprefs(host, port):
     """Creates or updates the ~/.iSeriesAccess/cwb_userprefs.ini file to
     specify a "Port lookup mode", which controls how the driver determines
@@ -63,21 +73,124 @@ def setup_port_configuration(config):
 def connection(config):
     # Docs on keywords this driver accepts:
     # https://www.ibm.com/support/knowledgecenter/ssw_ibm_i_71/rzaik/rzaikconnstrkeywordsgeneralprop.htm
+    options = {}
+    if config.get("fetch_block_size_kb"):
+        # The amount of data the driver fetches from the host at a time.
+        options["blocksize"] = int(config["fetch_block_size_kb"])
     return pyodbc.connect(
         driver="{IBM i Access ODBC Driver 64-bit}",
         system=config["host"],
         uid=config["user"],
-        pwd=config["password"])
+        pwd=config["password"],
+        **options)
+
+
+def _is_healthy(conn):
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT 1 FROM sysibm.sysdummy1")
+            cur.fetchall()
+        finally:
+            cur.close()
+        return True
+    except pyodbc.Error:
+        return False
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass
+
+
+class ConnectionPool(object):
+    """Hands out connections for one config, keeping those that are
+    returned in good shape around for reuse. Signing on to an IBM i host
+    takes long enough that reusing connections across discovery queries and
+    streams makes a noticeable difference."""
+    def __init__(self, config, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS):
+        self.config = config
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, idle_since = self._idle.pop()
+            if (time_() - idle_since < VALIDATE_AFTER_IDLE_SECONDS
+                    or _is_healthy(conn)):
+                return conn
+            LOGGER.info("Discarding broken pooled connection")
+            _close_quietly(conn)
+        return connection(self.config)
+
+    def release(self, conn, broken=False):
+        if not broken:
+            try:
+                # End the unit of work so no locks are held while idle.
+                conn.rollback()
+            except pyodbc.Error:
+                broken = True
+        with self._lock:
+            if not broken and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time_()))
+                return
+        _close_quietly(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _pool_key(config):
+    # Streams may use a different fetch block size, which is set when
+    # connecting, so they get a pool of their own.
+    return (config["host"], config.get("port"), config["user"],
+            config.get("fetch_block_size_kb"))
+
+
+def get_pool(config):
+    key = _pool_key(config)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            max_idle = int(config.get("max_idle_connections",
+                                      DEFAULT_MAX_IDLE_CONNECTIONS))
+            _POOLS[key] = ConnectionPool(config, max_idle)
+        return _POOLS[key]
+
+
+def close_pools():
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
 
 
 class get_cursor(object):
     def __init__(self, config):
-        self.conn = connection(config)
+        self.pool = get_pool(config)
+        self.conn = self.pool.acquire()
         self.cur = self.conn.cursor()
 
     def __enter__(self):
         return self.cur
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        self.cur.close()
-        self.conn.close()
+        broken = exc_type is not None and issubclass(exc_type, pyodbc.Error)
+        try:
+            self.cur.close()
+        except pyodbc.Error:
+            broken = True
+        self.pool.release(self.conn, broken)
@@ -0,0 +1,190 @@
+"""Compresses the tap's output as gzip or zstd on a background thread.
+
+Messages are handed to the compressing thread in chunks through a bounded
+queue, so compression overlaps with fetching rows while the queue still
+applies back-pressure when the output can't keep up. The compressed stream
+is flushed, so a target can decompress everything written so far, whenever
+enough output has built up or a second has passed since the last flush."""
+import queue
+import sys
+import threading
+import time
+import zlib
+import singer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = singer.get_logger()
+
+FORMATS = {"gzip", "zstd"}
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+CHUNK_SIZE = 256 * 1024
+FLUSH_INTERVAL = 1.0
+QUEUE_SIZE = 16
+
+# zlib's wbits for a gzip header and trailer around the deflate stream.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def check_config(config):
+    """Raises an exception if the compression settings can't be used."""
+    compression = config.get("output_compression")
+    if not compression:
+        return
+    if compression not in FORMATS:
+        raise Exception("Unknown output_compression {}, expected one of "
+                        "{}".format(compression, ", ".join(sorted(FORMATS))))
+    if compression == "zstd" and zstandard is None:
+        raise Exception("output_compression zstd requires zstandard, which "
+                        "can be installed with `pip install tap-db2[zstd]`")
+
+
+class _Gzip(object):
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _Zstd(object):
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+_COMPRESSORS = {"gzip": _Gzip, "zstd": _Zstd}
+
+# Queue items that are not text tell the compressing thread to flush or
+# finish the stream.
+_FLUSH = object()
+_FINISH = object()
+
+
+class CompressedOutput(object):
+    """A text file-like object that compresses what is written to it onto a
+    binary file."""
+    def __init__(self, raw, compression, level=None, close_raw=False):
+        self.raw = raw
+        self.close_raw = close_raw
+        self.compression = compression
+        if level is None:
+            level = DEFAULT_LEVELS[compression]
+        self._compressor = _COMPRESSORS[compression](int(level))
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._error = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        started = time.thread_time()
+        item = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _FINISH:
+                    self._write(self._compressor.finish())
+                    break
+                if item is _FLUSH:
+                    self._write(self._compressor.flush())
+                    self.raw.flush()
+                    continue
+                data = item.encode("utf-8")
+                self.bytes_in += len(data)
+                self._write(self._compressor.compress(data))
+            self.raw.flush()
+        except Exception as exc:  # pylint: disable=broad-except
+            self._error = exc
+            # Keep taking items so writers blocked on the queue notice the
+            # error instead of waiting forever.
+            while item is not _FINISH:
+                item = self._queue.get()
+        finally:
+            self.cpu_seconds = time.thread_time() - started
+
+    def _write(self, data):
+        if data:
+            self.raw.write(data)
+            self.bytes_out += len(data)
+
+    def _check(self):
+        if self._error is not None:
+            raise Exception("Writing compressed output failed") \
+                from self._error
+
+    def _send_pending(self):
+        if self._pending:
+            self._queue.put("".join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def write(self, text):
+        self._check()
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= CHUNK_SIZE:
+            self._send_pending()
+        return len(text)
+
+    def flush(self):
+        """Flushes the compressed stream if a second has passed since it
+        was last flushed. Writers flush after every message, and flushing
+        the compressor that often would ruin the compression ratio."""
+        self._check()
+        now = time.monotonic()
+        if now - self._last_flush >= FLUSH_INTERVAL:
+            self._send_pending()
+            self._queue.put(_FLUSH)
+            self._last_flush = now
+
+    def close(self):
+        """Finishes the compressed stream and logs how well it compressed.
+        The underlying file is closed too if close_raw was set."""
+        if not self._thread.is_alive():
+            return
+        self._send_pending()
+        self._queue.put(_FINISH)
+        self._thread.join()
+        if self.close_raw:
+            self.raw.close()
+        self._check()
+        LOGGER.info("Compressed output with %s from %d to %d bytes (ratio "
+                    "%.2f) using %.3f seconds of CPU", self.compression,
+                    self.bytes_in, self.bytes_out,
+                    self.bytes_in / self.bytes_out if self.bytes_out else 0,
+                    self.cpu_seconds)
+
+
+def open_output(config):
+    """Returns a CompressedOutput writing to output_file, or to stdout if it
+    isn't set."""
+    path = config.get("output_file")
+    if path:
+        return CompressedOutput(open(path, "wb"), config["output_compression"],
+                                config.get("output_compression_level"),
+                                close_raw=True)
+    return CompressedOutput(sys.stdout.buffer, config["output_compression"],
+                            config.get("output_compression_level"))
@@ -1,10 +1,15 @@
 import csv
-from collections import namedtuple
+import re
+import json
+import sys
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 from singer.catalog import Catalog, CatalogEntry
 import singer
 from singer import metadata
 from ..common import get_cursor
-from . import schemas
+from . import schemas, cache
 LOGGER = singer.get_logger()
 
 Table = namedtuple("Table", [
@@ -26,10 +31,77 @@ Column = namedtuple("Column", [
 
 SUPPORTED_TYPES = {"T", "V", "P"}
 
+# When more tables than this have changed since they were cached, their
+# columns and keys are queried without naming each table in the query.
+MAX_TARGETED_CACHE_TABLES = 200
+
 
 def _question_marks(lst):
     return ",".join("?" * len(lst))
 
+
+def _csv_list(config, key):
+    value_csv = config.get(key, "")
+    return [s.strip() for s in next(csv.reader([value_csv]), []) if s.strip()]
+
+
+def _like_pattern(pattern):
+    """Turns a pattern using * and ? wildcards into a LIKE pattern to be
+    used with ESCAPE '\\'."""
+    escaped = re.sub(r"([\\%_])", r"\\\1", pattern)
+    return escaped.replace("*", "%").replace("?", "_")
+
+
+def _filter_sql(config, schema_col, table_col):
+    """Returns a list of SQL predicates and their bindings restricting a
+    catalog query to the schemas in filter_schemas and to the tables
+    matching filter_tables. filter_tables is a CSV of table name patterns
+    where * matches any number of characters, ? matches a single character
+    and a leading ! excludes matching tables instead. Tables must match at
+    least one of the patterns that aren't exclusions, if there are any."""
+    predicates = []
+    bindings = []
+    schemas_ = _csv_list(config, "filter_schemas")
+    if schemas_:
+        predicates.append("{} IN ({})".format(schema_col,
+                                              _question_marks(schemas_)))
+        bindings += schemas_
+    patterns = _csv_list(config, "filter_tables")
+    includes = [p for p in patterns if not p.startswith("!")]
+    excludes = [p[1:] for p in patterns if p.startswith("!")]
+    like = "{} LIKE ? ESCAPE '\\'".format(table_col)
+    if includes:
+        predicates.append("({})".format(" OR ".join([like] * len(includes))))
+        bindings += [_like_pattern(p) for p in includes]
+    for pattern in excludes:
+        predicates.append("NOT " + like)
+        bindings.append(_like_pattern(pattern))
+    return predicates, bindings
+
+
+def _table_ids_predicate(table_ids, schema_col, table_col):
+    """Returns SQL and bindings matching any of the given (schema, table)
+    pairs."""
+    clause = "({} = ? AND {} = ?)".format(schema_col, table_col)
+    sql = "({})".format(" OR ".join([clause] * len(table_ids)))
+    bindings = [x for table_id in table_ids for x in table_id]
+    return sql, bindings
+
+
+def _tables_sql(config, columns):
+    sql = """
+        SELECT {}
+          FROM qsys2.systables
+         WHERE table_type IN ({})
+    """.format(", ".join(columns), _question_marks(SUPPORTED_TYPES))
+    bindings = list(SUPPORTED_TYPES)
+    predicates, filter_bindings = _filter_sql(config, "table_schema",
+                                              "table_name")
+    for predicate in predicates:
+        sql += " AND " + predicate
+    bindings += filter_bindings
+    return sql, bindings
+
 # Note the _query_* functions mainly exist for the sake of mocking in unit
 # tests. Normally I would prefer to have integration tests than mock out this
 # data, but DB2 databases aren't easy to come by and if there is a lot of data
@@ -37,74 +109,123 @@ def _question_marks(lst):
 def _query_tables(config):
     """Queries the qsys2 tables catalog and returns an iterator containing the
     raw results."""
-    sql = """
-        SELECT table_schema,
-               table_name,
-               table_type
-          FROM qsys2.systables
-         WHERE table_type IN ({})
-    """.format(_question_marks(SUPPORTED_TYPES))
-    bindings = list(SUPPORTED_TYPES)
-    schema_csv = config.get("filter_schemas", "")
-    schemas_ = [s.strip() for s in next(csv.reader([schema_csv]))]
-    if schemas_:
-        sql += "AND table_schema IN ({})".format(_question_marks(schemas_))
-        bindings += schemas_
+    sql, bindings = _tables_sql(config,
+                                ["table_schema", "table_name", "table_type"])
     with get_cursor(config) as cursor:
         cursor.execute(sql, bindings)
         yield from cursor
 
-def _query_columns(config):
+def _query_table_timestamps(config):
+    """Like _query_tables, but each result also includes the time the table
+    was last altered, which the discovery cache uses to tell which tables
+    have changed."""
+    sql, bindings = _tables_sql(config, ["table_schema",
+                                         "table_name",
+                                         "table_type",
+                                         "last_altered_timestamp"])
+    with get_cursor(config) as cursor:
+        cursor.execute(sql, bindings)
+        yield from cursor
+
+def _query_columns(config, table_ids=None):
     """Queries the qsys2 columns catalog and returns an iterator containing the
-    raw results."""
+    raw results. If table_ids is given, only the columns of those tables are
+    queried."""
+    sql = """
+        SELECT table_schema,
+               table_name,
+               column_name,
+               data_type,
+               character_maximum_length,
+               numeric_precision,
+               numeric_scale,
+               ccsid
+          FROM qsys2.syscolumns
+    """
+    predicates, binds = _filter_sql(config, "table_schema", "table_name")
+    if table_ids:
+        predicate, table_binds = _table_ids_predicate(
+            table_ids, "table_schema", "table_name")
+        predicates.append(predicate)
+        binds += table_binds
+    if predicates:
+        sql += " WHERE " + " AND ".join(predicates)
+    LOGGER.info("sql: %s, binds: %s", sql, binds)
     with get_cursor(config) as cursor:
-        sql = """
-        """
-        schema_csv = config.get("filter_schemas", "")
-        binds = [s.strip() for s in next(csv.reader([schema_csv]))]
-        if len(binds) != 0:
-            sql = """
-            SELECT table_schema,
-                   table_name,
-                   column_name,
-                   data_type,
-                   character_maximum_length,
-                   numeric_precision,
-                   numeric_scale,
-                   ccsid
-              FROM qsys2.syscolumns
-             WHERE table_schema IN ({})
-            """.format(_question_marks(binds))
-            LOGGER.info("sql: %s, binds: %s", sql, binds)
-            cursor.execute(sql, binds)
-        else:
-            cursor.execute("""
-            SELECT table_schema,
-                   table_name,
-                   column_name,
-                   data_type,
-                   character_maximum_length,
-                   numeric_precision,
-                   numeric_scale
-              FROM qsys2.syscolumns
-            """)
+        cursor.execute(sql, binds)
         yield from cursor
 
-def _query_primary_keys(config):
+def _query_primary_keys(config, table_ids=None):
     """Queries the qsys2 primary key catalog and returns an iterator containing
-    the raw results."""
+    the raw results. If table_ids is given, only the keys of those tables are
+    queried."""
+    sql = """
+        SELECT A.table_schema,
+               A.table_name,
+               A.column_name,
+               A.ordinal_position
+          FROM qsys2.syskeycst A
+          JOIN qsys2.syscst B
+            ON A.constraint_schema = B.constraint_schema
+           AND A.constraint_name = B.constraint_name
+         WHERE B.constraint_type = 'PRIMARY KEY'
+    """
+    predicates, binds = _filter_sql(config, "A.table_schema", "A.table_name")
+    if table_ids:
+        predicate, table_binds = _table_ids_predicate(
+            table_ids, "A.table_schema", "A.table_name")
+        predicates.append(predicate)
+        binds += table_binds
+    for predicate in predicates:
+        sql += " AND " + predicate
+    with get_cursor(config) as cursor:
+        cursor.execute(sql, binds)
+        yield from cursor
+
+
+def _query_catalog(config):
+    """Queries every table along with its columns, their position in the
+    primary key, if any, and the table's type, ordered by table. Used for
+    streaming discovery, where each table is written out as soon as all of
+    its columns have been read. Tables without readable columns come back
+    as a single row whose column values are NULL, as discover() still
+    writes an entry for them."""
+    predicates, binds = _filter_sql(config, "T.table_schema", "T.table_name")
+    sql = """
+        SELECT T.table_schema,
+               T.table_name,
+               T.table_type,
+               C.column_name,
+               C.data_type,
+               C.character_maximum_length,
+               C.numeric_precision,
+               C.numeric_scale,
+               C.ccsid,
+               K.ordinal_position
+          FROM qsys2.systables T
+          LEFT JOIN qsys2.syscolumns C
+            ON C.table_schema = T.table_schema
+           AND C.table_name = T.table_name
+          LEFT JOIN (SELECT A.table_schema,
+                            A.table_name,
+                            A.column_name,
+                            A.ordinal_position
+                       FROM qsys2.syskeycst A
+                       JOIN qsys2.syscst B
+                         ON A.constraint_schema = B.constraint_schema
+                        AND A.constraint_name = B.constraint_name
+                      WHERE B.constraint_type = 'PRIMARY KEY') K
+            ON K.table_schema = C.table_schema
+           AND K.table_name = C.table_name
+           AND K.column_name = C.column_name
+         WHERE T.table_type IN ({})
+    """.format(_question_marks(SUPPORTED_TYPES))
+    binds = list(SUPPORTED_TYPES) + binds
+    for predicate in predicates:
+        sql += " AND " + predicate
+    sql += " ORDER BY T.table_schema, T.table_name, C.ordinal_position"
     with get_cursor(config) as cursor:
-        cursor.execute("""
-            SELECT A.table_schema,
-                   A.table_name,
-                   A.column_name,
-                   A.ordinal_position
-              FROM qsys2.syskeycst A
-              JOIN qsys2.syscst B
-                ON A.constraint_schema = B.constraint_schema
-               AND A.constraint_name = B.constraint_name
-             WHERE B.constraint_type = 'PRIMARY KEY'
-        """)
+        cursor.execute(sql, binds)
         yield from cursor
 
 
@@ -128,10 +249,16 @@ def _col_table_id(column):
     return (column.table_schema, column.table_name)
 
 
-def _find_columns(config, tables):
-    cols = (Column(*rec) for rec in _query_columns(config))
+def _find_columns(config, get_tables, table_ids=None):
+    """Returns a dict of table ids to lists of their Columns. get_tables is
+    called to get the tables once the first column has arrived, so the
+    columns query can run while the tables are still being fetched."""
+    cols = (Column(*rec) for rec in _query_columns(config, table_ids))
+    tables = None
     ret = {}
     for col in cols:
+        if tables is None:
+            tables = get_tables()
         table_id = _col_table_id(col)
         if table_id not in tables:
             continue
@@ -143,13 +270,17 @@ def _find_columns(config, tables):
     return ret
 
 
-def _find_primary_keys(config, tables):
+def _find_primary_keys(config, get_tables, table_ids=None):
     """Returns a dict of tuples -> list where the keys are \"table ids\" -
     ie. the (schema name, table_name) and the values are the primary key
-    columns, sorted by their ordinal position."""
-    results = _query_primary_keys(config)
+    columns, sorted by their ordinal position. As with _find_columns,
+    get_tables is only called once the first key has arrived."""
+    results = _query_primary_keys(config, table_ids)
+    tables = None
     keys = {}
     for (table_schema, table_name, column_name, ordinal_pos) in results:
+        if tables is None:
+            tables = get_tables()
         table_id = (table_schema, table_name)
         if table_id not in tables:
             continue
@@ -200,24 +331,112 @@ def _update_entry_for_table_type(catalog_entry, table_type):
         catalog_entry.schema.description = err
 
 
-def discover(config):
-    tables = _find_tables(config)
-    columns = _find_columns(config, tables)
-    pks = _find_primary_keys(config, tables)
+def _create_entry(table, cols, pk_columns):
+    schema = schemas.generate(cols, pk_columns)
+    entry = CatalogEntry(
+        database=table.table_schema,
+        table=table.table_name,
+        stream=table.table_name,
+        metadata=_create_column_metadata(cols, schema, pk_columns),
+        tap_stream_id="{}-{}".format(table.table_schema, table.table_name),
+        schema=schema)
+    _update_entry_for_table_type(entry, table.table_type)
+    return entry
+
+
+def _discover_entries(config, get_tables, table_ids=None):
+    """Returns an OrderedDict of table ids to CatalogEntries for the tables
+    returned by get_tables. If table_ids is given, columns and keys are only
+    queried for those tables."""
+    # The three catalog queries are slow on big systems, so they run at the
+    # same time on separate connections.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        tables_future = executor.submit(get_tables)
+        columns_future = executor.submit(_find_columns, config,
+                                         tables_future.result, table_ids)
+        pks_future = executor.submit(_find_primary_keys, config,
+                                     tables_future.result, table_ids)
+        tables = tables_future.result()
+        columns = columns_future.result()
+        pks = pks_future.result()
+    entries = OrderedDict()
+    for table_id, table in tables.items():
+        entries[table_id] = _create_entry(table,
+                                          columns.get(table_id, []),
+                                          pks.get(table_id, []))
+    return entries
+
+
+def _discover_with_cache(config):
+    """Discovers the catalog, only querying the columns and keys of tables
+    that are new or were altered since they were cached."""
+    cached = cache.load(config)
+    tables = OrderedDict()
+    last_altered = {}
+    for rec in _query_table_timestamps(config):
+        table = Table(*rec[:3])
+        table_id = _table_id(table)
+        tables[table_id] = table
+        last_altered[table_id] = rec[3].isoformat() if rec[3] else None
+    stale = OrderedDict(
+        (table_id, table) for table_id, table in tables.items()
+        if table_id not in cached
+        or last_altered[table_id] is None
+        or cached[table_id].last_altered != last_altered[table_id])
+    LOGGER.info("%d of %d tables are new or changed since the last discovery",
+                len(stale), len(tables))
+    fresh = {}
+    if stale:
+        table_ids = None
+        if len(stale) <= MAX_TARGETED_CACHE_TABLES:
+            table_ids = list(stale)
+        fresh = _discover_entries(config, lambda: stale, table_ids)
     entries = []
+    to_cache = {}
     for table_id in tables:
-        table_schema, table_name = table_id
-        cols = columns.get(table_id, [])
-        pk_columns = pks.get(table_id, [])
-        schema = schemas.generate(cols, pk_columns)
-        entry = CatalogEntry(
-            database=table_schema,
-            table=table_name,
-            stream=table_name,
-            metadata=_create_column_metadata(cols, schema, pk_columns),
-            tap_stream_id="{}-{}".format(table_schema, table_name),
-            schema=schema)
-
-        _update_entry_for_table_type(entry, tables[table_id].table_type)
+        if table_id in fresh:
+            entry = fresh[table_id]
+            entry_dict = entry.to_dict()
+        else:
+            entry_dict = cached[table_id].entry
+            entry = Catalog.from_dict({"streams": [entry_dict]}).streams[0]
         entries.append(entry)
+        to_cache[table_id] = cache.CachedTable(last_altered[table_id],
+                                               entry_dict)
+    cache.save(config, to_cache)
     return Catalog(entries)
+
+
+def discover(config):
+    if config.get("discovery_cache_dir"):
+        return _discover_with_cache(config)
+    entries = _discover_entries(config, lambda: _find_tables(config))
+    return Catalog(list(entries.values()))
+
+
+def _stream_entries(config):
+    """Yields a CatalogEntry per table, building each one from the rows of
+    _query_catalog as soon as the table's last column has been read."""
+    rows = _query_catalog(config)
+    for table_id, table_rows in groupby(rows, key=lambda r: (r[0], r[1])):
+        table_rows = list(table_rows)
+        table = Table(table_id[0], table_id[1], table_rows[0][2])
+        cols = [Column(*(r[:2] + r[3:9])) for r in table_rows
+                if r[3] is not None]
+        pk_columns = [r[3] for r in sorted(
+            (r for r in table_rows if r[9] is not None), key=lambda r: r[9])]
+        yield _create_entry(table, cols, pk_columns)
+
+
+def dump_streaming(config, out=None):
+    """Writes the catalog to out (stdout by default) one entry at a time, so
+    memory use depends on the widest table rather than on the number of
+    tables."""
+    out = out or sys.stdout
+    out.write('{\n  "streams": [')
+    for i, entry in enumerate(_stream_entries(config)):
+        if i:
+            out.write(",")
+        out.write("\n    ")
+        out.write(json.dumps(entry.to_dict(), indent=2).replace("\n", "\n    "))
+    out.write("\n  ]\n}")
@@ -0,0 +1,64 @@
+"""Keeps discovered catalog entries on disk between runs, so that discovery
+only has to query the columns and keys of tables that changed since."""
+import hashlib
+import json
+import os
+from collections import namedtuple
+import singer
+
+LOGGER = singer.get_logger()
+
+# Bump this whenever the entries discovery generates change, so that stale
+# cache files are ignored.
+CACHE_FORMAT_VERSION = 1
+
+CachedTable = namedtuple("CachedTable", ["last_altered", "entry"])
+
+
+def _cache_path(config):
+    # The discovered tables depend on the host and on the discovery filters,
+    # so each combination gets its own file.
+    key = json.dumps([config["host"],
+                      config.get("filter_schemas", ""),
+                      config.get("filter_tables", "")])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    cache_dir = os.path.expanduser(config["discovery_cache_dir"])
+    return os.path.join(cache_dir, "tap-db2-discovery-{}.json".format(digest))
+
+
+def load(config):
+    """Returns a dict of table ids to CachedTables, which is empty if there
+    is no usable cache."""
+    path = _cache_path(config)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        LOGGER.warning("Ignoring unreadable discovery cache %s", path)
+        return {}
+    if data.get("version") != CACHE_FORMAT_VERSION:
+        return {}
+    return {(t["table_schema"], t["table_name"]):
+            CachedTable(t["last_altered"], t["entry"])
+            for t in data["tables"]}
+
+
+def save(config, tables):
+    """Writes a dict of table ids to CachedTables, replacing the previous
+    cache file in one step."""
+    path = _cache_path(config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        "version": CACHE_FORMAT_VERSION,
+        "tables": [{"table_schema": table_schema,
+                    "table_name": table_name,
+                    "last_altered": cached.last_altered,
+                    "entry": cached.entry}
+                   for (table_schema, table_name), cached in tables.items()],
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
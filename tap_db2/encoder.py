@@ -0,0 +1,75 @@
+"""Keeps the pool of worker processes that convert and encode batches of rows
+as RECORD messages when encode_workers is set.
+
+Converting and encoding are CPU-bound, and on wide tables they can take up a
+whole core while fetching and writing wait on it. Workers only turn rows into
+text: the stream's own thread writes the encoded blocks in the order the
+batches were fetched and is the only one to touch bookmarks and STATE."""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import singer
+from . import output
+
+LOGGER = singer.get_logger()
+
+# Batches in flight for each worker, so a worker always has the next batch
+# waiting while the stream's thread writes out a finished one.
+BATCHES_PER_WORKER = 2
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def workers(config):
+    return int(config.get("encode_workers", 0))
+
+
+def enabled(config):
+    return workers(config) > 0
+
+
+def max_pending(config):
+    """Returns how many batches of a stream may be encoding at once."""
+    return workers(config) * BATCHES_PER_WORKER
+
+
+def _init_worker(fast_output):
+    # Workers encode records the same way the tap's writer would.
+    if fast_output:
+        output.set_writer(output.BufferedMessageWriter())
+    else:
+        output.set_writer(output.MessageWriter())
+
+
+def _mp_context():
+    # By the time the pool starts, parallel streams, prefetching and
+    # compression may have threads running, and a child forked from a
+    # multithreaded process can deadlock on a lock one of them held.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def get_pool(config):
+    """Returns the worker pool, starting it on first use. Streams synced in
+    parallel share it."""
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is None:
+            LOGGER.info("Starting %d encoding worker processes",
+                        workers(config))
+            _POOL = ProcessPoolExecutor(
+                max_workers=workers(config), mp_context=_mp_context(),
+                initializer=_init_worker,
+                initargs=(bool(config.get("fast_output")),))
+        return _POOL
+
+
+def shutdown():
+    """Stops the worker pool, if it was started."""
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown()
+            _POOL = None
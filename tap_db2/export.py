@@ -0,0 +1,213 @@
+"""Writes streams to Arrow IPC or Parquet files instead of RECORD messages.
+
+Rows are written in columnar batches as they are fetched, to one file at a
+time per stream and thread, which is closed once it reaches
+export_file_size_mb. Bookmarks only ever move past rows in files that have
+been closed: the bookmark update for the last row written is held back until
+the file it went into is closed, and a STATE message is written then."""
+import itertools
+import os
+import re
+import threading
+from decimal import Decimal
+import singer
+from singer import metadata
+from . import output
+from .discovery import schemas
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOGGER = singer.get_logger()
+
+DEFAULT_EXPORT_FILE_SIZE_MB = 512
+FORMATS = {"arrow", "parquet"}
+_MAX_DECIMAL128_PRECISION = 38
+
+
+def enabled(config):
+    return bool(config.get("export_format"))
+
+
+def check_config(config):
+    """Raises an exception if the export settings can't be used."""
+    if not enabled(config):
+        return
+    if config["export_format"] not in FORMATS:
+        raise Exception("Unknown export_format {}, expected one of {}".format(
+            config["export_format"], ", ".join(sorted(FORMATS))))
+    if not config.get("export_dir"):
+        raise Exception("export_dir is required with export_format")
+    if pyarrow is None:
+        raise Exception("export_format requires pyarrow, which can be "
+                        "installed with `pip install tap-db2[export]`")
+
+
+def _decimal_type(column_schema):
+    # Discovery describes DECIMAL(p, s) as multipleOf 10^-s and an exclusive
+    # maximum of 10^(p - s).
+    scale = -Decimal(str(column_schema.multipleOf)).as_tuple().exponent
+    precision = len(str(int(column_schema.maximum))) - 1 + scale
+    if precision > _MAX_DECIMAL128_PRECISION:
+        return pyarrow.decimal256(precision, scale)
+    return pyarrow.decimal128(precision, scale)
+
+
+def arrow_type(catalog_entry, column):
+    """Returns the Arrow type a column's values are written as."""
+    column_schema = catalog_entry.schema.properties.get(column)
+    if column_schema is None:
+        # Columns the tap adds, like _sdc_deleted_at, are timestamps.
+        return pyarrow.timestamp("us", tz="UTC")
+    data_type = metadata.get(metadata.to_map(catalog_entry.metadata),
+                             ("properties", column), "sql-datatype")
+    if data_type in schemas.BYTES_FOR_INTEGER_TYPE:
+        bits = schemas.BYTES_FOR_INTEGER_TYPE[data_type] * 8
+        return getattr(pyarrow, "int{}".format(bits))()
+    if data_type in schemas.FLOAT_TYPES:
+        return pyarrow.float64()
+    if data_type in schemas.DECIMAL_TYPES:
+        return _decimal_type(column_schema)
+    if data_type == "date":
+        return pyarrow.date32()
+    if data_type == "time":
+        return pyarrow.time64("us")
+    if data_type == "timestmp":
+        return pyarrow.timestamp("us", tz="UTC")
+    return pyarrow.string()
+
+
+def _directory(config, catalog_entry):
+    return os.path.join(config["export_dir"], catalog_entry.tap_stream_id)
+
+
+def _first_free_part(directory, stream_version):
+    """Returns the part number after the last file already written for a
+    stream version. A run resuming the version, after an interruption or
+    from the same state, must not overwrite files that were bookmarked."""
+    if not os.path.isdir(directory):
+        return 0
+    pattern = re.compile(r"{}-(\d+)\.".format(stream_version))
+    parts = [int(match.group(1)) for match in map(pattern.match,
+                                                  os.listdir(directory))
+             if match]
+    return max(parts, default=-1) + 1
+
+
+class StreamExporter(object):
+    """Writes the rows of one stream to a series of files."""
+    def __init__(self, config, catalog_entry, columns, stream_version, parts):
+        self.format = config["export_format"]
+        self.max_bytes = int(float(config.get("export_file_size_mb",
+                                              DEFAULT_EXPORT_FILE_SIZE_MB))
+                             * 1024 * 1024)
+        self.directory = _directory(config, catalog_entry)
+        self.stream_version = stream_version
+        self.columns = columns
+        self.schema = pyarrow.schema([(c, arrow_type(catalog_entry, c))
+                                      for c in columns])
+        # DECFLOAT values are fetched as Decimals, which pyarrow won't
+        # convert to float64 by itself.
+        mdata = metadata.to_map(catalog_entry.metadata)
+        self._decfloats = {
+            i for i, c in enumerate(columns)
+            if metadata.get(mdata, ("properties", c),
+                            "sql-datatype") == "decfloat"}
+        self._parts = parts
+        self._path = None
+        self._sink = None
+        self._writer = None
+        self._on_close = None
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, "{}-{:05d}.{}".format(
+            self.stream_version, next(self._parts), self.format))
+        if self.format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(self._path,
+                                                         self.schema)
+        else:
+            self._sink = pyarrow.OSFile(self._path, "wb")
+            self._writer = pyarrow.ipc.new_file(self._sink, self.schema)
+
+    def _size(self):
+        if self._sink is not None:
+            return self._sink.tell()
+        return os.path.getsize(self._path)
+
+    def write(self, rows, on_close):
+        """Writes a batch of rows. on_close is called once the file the
+        rows went into has been closed, unless a later batch's on_close
+        replaces it first."""
+        if self._writer is None:
+            self._open()
+        # Rows may carry extra trailing values, like an RRN, which are
+        # dropped here.
+        values = list(zip(*rows))
+        for i in self._decfloats:
+            values[i] = [None if v is None else float(v) for v in values[i]]
+        arrays = [pyarrow.array(values[i], type=field.type)
+                  for i, field in enumerate(self.schema)]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.format == "parquet":
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self._on_close = on_close
+        if self._size() >= self.max_bytes:
+            self.close()
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        LOGGER.info("Wrote %s", self._path)
+        self._writer = self._sink = None
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+
+_EXPORTERS = {}
+_PARTS = {}
+_EXPORTERS_LOCK = threading.Lock()
+
+
+def get(config, catalog_entry, columns, stream_version):
+    """Returns the exporter of a stream for the current thread. Partitions
+    synced concurrently each write files of their own."""
+    key = (catalog_entry.tap_stream_id, threading.get_ident())
+    with _EXPORTERS_LOCK:
+        if key not in _EXPORTERS:
+            directory = _directory(config, catalog_entry)
+            if (directory, stream_version) not in _PARTS:
+                _PARTS[(directory, stream_version)] = itertools.count(
+                    _first_free_part(directory, stream_version))
+            parts = _PARTS[(directory, stream_version)]
+            _EXPORTERS[key] = StreamExporter(config, catalog_entry, columns,
+                                             stream_version, parts)
+        return _EXPORTERS[key]
+
+
+def close(catalog_entry):
+    """Closes the current thread's file for a stream, if it has one open."""
+    key = (catalog_entry.tap_stream_id, threading.get_ident())
+    with _EXPORTERS_LOCK:
+        exporter = _EXPORTERS.pop(key, None)
+    if exporter is not None:
+        exporter.close()
+
+
+def bookmark_on_close(state, update_bookmarks, record, row):
+    """Returns an on_close callback that moves the bookmarks to a row and
+    writes a STATE message."""
+    def on_close():
+        with output.lock():
+            update_bookmarks(state, record, row)
+            output.write_state(state)
+    return on_close
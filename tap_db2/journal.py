@@ -0,0 +1,252 @@
+"""Reads the changes made to a table from its journal, for LOG_BASED
+replication.
+
+Journal entries are read with QSYS2.DISPLAY_JOURNAL. Each entry for a row
+change carries an image of the row as it is stored in the table, which is
+decoded here using the storage layout of the table's columns from
+qsys2.syscolumns. Inserts and updates carry the row after the change and
+deletes the row before it."""
+import codecs
+import struct
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+Journal = namedtuple("Journal", ["library", "name",
+                                 "object_library", "object_name"])
+Field = namedtuple("Field", ["index", "name", "data_type", "offset",
+                             "storage", "scale", "codec"])
+
+INSERT_TYPES = {"PT", "PX"}
+UPDATE_TYPES = {"UP", "UR"}
+# DR entries remove rows inserted by a transaction that was rolled back.
+DELETE_TYPES = {"DL", "DR"}
+
+# Character data is decoded with the codec for its column's CCSID. CCSIDs
+# not listed here are tried as the matching code page, e.g. cp037 or cp500.
+_CODECS = {
+    1200: "utf-16-be",
+    1208: "utf-8",
+    13488: "utf-16-be",
+}
+_DEFAULT_CODEC = "cp037"
+_FLOAT_FORMATS = {4: ">f", 8: ">d"}
+_UNSUPPORTED_TYPES = {"DECFLOAT"}
+
+
+def _quote_literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def find_journal(cursor, catalog_entry):
+    """Returns the Journal a table is journaled to, using the system names
+    of the table, which is what DISPLAY_JOURNAL expects."""
+    cursor.execute("""SELECT O.journal_library,
+                             O.journal_name,
+                             T.system_table_schema,
+                             T.system_table_name
+                        FROM qsys2.systables T,
+                             TABLE(qsys2.object_statistics(
+                                 T.system_table_schema, '*FILE',
+                                 T.system_table_name)) O
+                       WHERE T.table_schema = ? AND T.table_name = ?""",
+                   (catalog_entry.database, catalog_entry.table))
+    row = cursor.fetchone()
+    if row is None or not row[1]:
+        raise Exception("Table {}.{} is not journaled, so it cannot use "
+                        "LOG_BASED replication".format(catalog_entry.database,
+                                                       catalog_entry.table))
+    return Journal(*[value.strip() for value in row])
+
+
+def current_sequence(cursor, journal):
+    """Returns the sequence number of the latest entry in the journal's
+    current receiver."""
+    cursor.execute("""SELECT MAX(sequence_number)
+                        FROM TABLE(qsys2.display_journal(
+                            ?, ?, starting_receiver_name => '*CURRENT')) J""",
+                   (journal.library, journal.name))
+    sequence = cursor.fetchone()[0]
+    return int(sequence or 0)
+
+
+def current_timezone(cursor):
+    """Returns the offset of the system's time zone from UTC."""
+    cursor.execute("SELECT CURRENT TIMEZONE FROM sysibm.sysdummy1")
+    # CURRENT TIMEZONE is a signed duration written as hhmmss.
+    value = int(cursor.fetchone()[0])
+    sign = -1 if value < 0 else 1
+    value = abs(value)
+    return sign * timedelta(hours=value // 10000, minutes=value // 100 % 100,
+                            seconds=value % 100)
+
+
+def record_layout(cursor, catalog_entry):
+    """Returns a Field for every column of a table, in the order they are
+    stored in a row image."""
+    cursor.execute("""SELECT column_name,
+                             data_type,
+                             storage,
+                             numeric_scale,
+                             ccsid
+                        FROM qsys2.syscolumns
+                       WHERE table_schema = ? AND table_name = ?
+                       ORDER BY ordinal_position""",
+                   (catalog_entry.database, catalog_entry.table))
+    layout = []
+    offset = 0
+    for index, (name, data_type, storage, scale, ccsid) in enumerate(
+            cursor.fetchall()):
+        data_type = data_type.strip()
+        codec = _CODECS.get(ccsid, "cp{:03d}".format(ccsid) if ccsid else
+                            _DEFAULT_CODEC)
+        try:
+            codecs.lookup(codec)
+        except LookupError:
+            codec = None
+        layout.append(Field(index, name, data_type, offset, storage,
+                            scale or 0, codec))
+        offset += storage
+    return layout
+
+
+def check_layout(layout, columns):
+    """Raises an exception if any of columns can't be decoded from a row
+    image."""
+    fields = {field.name: field for field in layout}
+    for column in columns:
+        field = fields.get(column)
+        if field is None:
+            raise Exception("Column {} was not found in the table".format(
+                column))
+        if field.data_type in _UNSUPPORTED_TYPES or field.codec is None:
+            raise Exception("Column {} of type {} cannot be read from the "
+                            "journal".format(column, field.data_type))
+
+
+def entries_sql(journal, starting_sequence):
+    """Returns SQL and params selecting the row changes to a table from
+    starting_sequence on, in the order they were made."""
+    entry_types = ",".join(sorted(INSERT_TYPES | UPDATE_TYPES | DELETE_TYPES))
+    select = """SELECT J.journal_entry_type,
+                       J.entry_timestamp,
+                       J.entry_data,
+                       J.null_value_indicators,
+                       J.sequence_number
+                  FROM TABLE(qsys2.display_journal(
+                      ?, ?,
+                      starting_receiver_name => '*CURCHAIN',
+                      starting_sequence => ?,
+                      journal_codes => 'R',
+                      journal_entry_types => {},
+                      object_library => ?,
+                      object_name => ?,
+                      object_objtype => '*FILE',
+                      object_member => '*ALL')) J
+                 ORDER BY J.sequence_number""".format(
+                     _quote_literal(entry_types))
+    return select, (journal.library, journal.name, starting_sequence,
+                    journal.object_library, journal.object_name)
+
+
+def _decode_packed(data, scale):
+    digits = data.hex()
+    value = Decimal(digits[:-1])
+    if digits[-1] in "bd":
+        value = -value
+    return value.scaleb(-scale)
+
+
+def _decode_zoned(data, scale):
+    value = Decimal("".join(str(b & 0x0F) for b in data))
+    if data[-1] >> 4 in (0xB, 0xD):
+        value = -value
+    return value.scaleb(-scale)
+
+
+def _decode_timestamp(text):
+    # Timestamps are stored as yyyy-mm-dd-hh.mm.ss.ffffff, with as many
+    # fractional digits as the column's precision.
+    value = datetime.strptime(text[:19], "%Y-%m-%d-%H.%M.%S")
+    fraction = text[20:26]
+    if fraction:
+        value = value.replace(microsecond=int(fraction.ljust(6, "0")))
+    return value
+
+
+def _decode_field(field, data, timezone):
+    data_type = field.data_type
+    if data_type in ("SMALLINT", "INTEGER", "BIGINT"):
+        value = int.from_bytes(data, "big", signed=True)
+        if field.scale:
+            return Decimal(value).scaleb(-field.scale)
+        return value
+    if data_type == "DECIMAL":
+        return _decode_packed(data, field.scale)
+    if data_type == "NUMERIC":
+        return _decode_zoned(data, field.scale)
+    if data_type == "FLOAT":
+        return struct.unpack(_FLOAT_FORMATS[field.storage], data)[0]
+    if data_type == "VARCHAR":
+        length = int.from_bytes(data[:2], "big")
+        return data[2:2 + length].decode(field.codec)
+    text = data.decode(field.codec)
+    if data_type == "DATE":
+        return datetime.strptime(text, "%Y-%m-%d").date()
+    if data_type == "TIME":
+        return datetime.strptime(text, "%H.%M.%S").time()
+    if data_type == "TIMESTMP":
+        return _decode_timestamp(text) - timezone
+    return text
+
+
+def _is_null(indicators, index):
+    if not indicators or index >= len(indicators):
+        return False
+    # Each indicator is an EBCDIC "0" or "1", which drivers return as either
+    # bytes or text.
+    return indicators[index] in (0xF1, "1")
+
+
+class JournalCursor(object):
+    """Wraps a cursor that has run entries_sql, and returns the entries as
+    rows made up of the values of columns, followed by the time the row was
+    deleted (None unless the entry is a delete) and the entry's sequence
+    number."""
+    def __init__(self, cursor, layout, columns, timezone):
+        self.cursor = cursor
+        self.timezone = timezone
+        fields = {field.name: field for field in layout}
+        self.fields = [fields[c] for c in columns]
+        self.image_length = sum(field.storage for field in layout)
+
+    @property
+    def arraysize(self):
+        return self.cursor.arraysize
+
+    @arraysize.setter
+    def arraysize(self, value):
+        self.cursor.arraysize = value
+
+    def _decode(self, entry):
+        entry_type, timestamp, image, indicators, sequence = entry
+        if len(image) < self.image_length:
+            raise Exception("Journal entry {} holds a partial row image. "
+                            "Journals with minimized entry data are not "
+                            "supported".format(sequence))
+        values = [None if _is_null(indicators, field.index) else
+                  _decode_field(field,
+                                image[field.offset:field.offset
+                                      + field.storage],
+                                self.timezone)
+                  for field in self.fields]
+        deleted_at = None
+        if entry_type.strip() in DELETE_TYPES:
+            deleted_at = timestamp - self.timezone
+        values.append(deleted_at)
+        values.append(sequence)
+        return tuple(values)
+
+    def fetchmany(self, size=None):
+        return [self._decode(entry)
+                for entry in self.cursor.fetchmany(size or self.arraysize)]
@@ -0,0 +1,199 @@
+"""Serializes Singer messages onto the tap's output.
+
+Every message the tap produces goes through a single MessageWriter so that
+streams synced on concurrent workers can share stdout without interleaving
+partial lines, and so that STATE messages can be written while no other
+worker is halfway through updating its bookmarks."""
+import sys
+import threading
+import simplejson
+import singer
+from . import compression
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+DEFAULT_OUTPUT_BUFFER_SIZE_MB = 8
+
+
+class MessageWriter(object):
+    def __init__(self, out=None):
+        # Bookmark updates and STATE writes must both happen while holding
+        # this lock. Otherwise a STATE message could be serialized while
+        # another stream's worker is mutating the state dict.
+        self.lock = threading.RLock()
+        self._out = out
+
+    @property
+    def out(self):
+        # Resolve sys.stdout lazily so redirection (e.g. in tests) is
+        # respected.
+        return self._out or sys.stdout
+
+    def write_message(self, message):
+        """Writes a message and returns the length of what was written."""
+        return self.write_line(singer.format_message(message) + "\n")
+
+    def write_line(self, line):
+        """Writes an already encoded message, including its newline."""
+        with self.lock:
+            self.out.write(line)
+            self.out.flush()
+        return len(line)
+
+    def encode_record(self, stream, version, record):
+        """Returns the line write_record would write for a record."""
+        return singer.format_message(singer.RecordMessage(
+            stream=stream, record=record, version=version)) + "\n"
+
+    def write_record(self, stream, version, record):
+        return self.write_line(self.encode_record(stream, version, record))
+
+    def write_state(self, state):
+        with self.lock:
+            self.write_message(singer.StateMessage(value=state))
+
+    def flush(self):
+        pass
+
+
+def _json_encoder():
+    """Returns a function that encodes a record as JSON, writing Decimal
+    values as JSON numbers. python-rapidjson is used when it is installed,
+    since it handles Decimal natively in C. Otherwise a single simplejson
+    encoder is reused, which is what singer.format_message does minus the
+    cost of constructing a new encoder for every message. Like simplejson,
+    both write NaN and infinite FLOAT values as NaN, Infinity and
+    -Infinity."""
+    if rapidjson is not None:
+        return rapidjson.Encoder(
+            number_mode=(rapidjson.NM_NATIVE | rapidjson.NM_DECIMAL
+                         | rapidjson.NM_NAN))
+    return simplejson.JSONEncoder(use_decimal=True).encode
+
+
+def _record_envelope(stream, version):
+    """Returns the text that goes before and after the encoded record of a
+    RECORD message, in the same key order singer.format_message uses."""
+    prefix = '{{"type": "RECORD", "stream": {}, "record": '.format(
+        simplejson.dumps(stream))
+    if version is None:
+        return prefix, "}\n"
+    return prefix, ', "version": {}}}\n'.format(simplejson.dumps(version))
+
+
+class BufferedMessageWriter(MessageWriter):
+    """Writes RECORD messages without building singer.RecordMessage objects,
+    using an envelope encoded once per stream version, and holds output in a
+    buffer that is written out once it fills up or when STATE is written."""
+    def __init__(self, out=None,
+                 buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE_MB * 1024 * 1024):
+        super().__init__(out)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._envelopes = {}
+        self._encode = _json_encoder()
+
+    def write_line(self, text):
+        with self.lock:
+            self._buffer.append(text)
+            self._buffered += len(text)
+            if self._buffered >= self.buffer_size:
+                self._write_buffer()
+        return len(text)
+
+    def _write_buffer(self):
+        if self._buffer:
+            self.out.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def encode_record(self, stream, version, record):
+        envelope = self._envelopes.get((stream, version))
+        if envelope is None:
+            envelope = _record_envelope(stream, version)
+            self._envelopes[(stream, version)] = envelope
+        prefix, suffix = envelope
+        return prefix + self._encode(record) + suffix
+
+    def write_state(self, state):
+        with self.lock:
+            self.write_message(singer.StateMessage(value=state))
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._write_buffer()
+            self.out.flush()
+
+
+_WRITER = MessageWriter()
+
+
+def get_writer():
+    return _WRITER
+
+
+def set_writer(writer):
+    global _WRITER  # pylint: disable=global-statement
+    _WRITER = writer
+
+
+def write_message(message):
+    return _WRITER.write_message(message)
+
+
+def write_record(stream, version, record):
+    return _WRITER.write_record(stream, version, record)
+
+
+def encode_record(stream, version, record):
+    return _WRITER.encode_record(stream, version, record)
+
+
+def write_line(line):
+    return _WRITER.write_line(line)
+
+
+def write_state(state):
+    _WRITER.write_state(state)
+
+
+def flush():
+    _WRITER.flush()
+
+
+_COMPRESSED_OUTPUT = None
+
+
+def configure(config, out=None):
+    """Chooses the writer for the run based on the tap config. Output goes
+    to stdout unless out is given or output_compression is set."""
+    global _COMPRESSED_OUTPUT  # pylint: disable=global-statement
+    if config.get("output_compression"):
+        out = _COMPRESSED_OUTPUT = compression.open_output(config)
+    if config.get("fast_output"):
+        buffer_size_mb = config.get("output_buffer_size_mb",
+                                    DEFAULT_OUTPUT_BUFFER_SIZE_MB)
+        set_writer(BufferedMessageWriter(
+            out, buffer_size=int(float(buffer_size_mb) * 1024 * 1024)))
+    else:
+        set_writer(MessageWriter(out))
+
+
+def close():
+    """Flushes the writer and finishes the compressed output, if any."""
+    global _COMPRESSED_OUTPUT  # pylint: disable=global-statement
+    _WRITER.flush()
+    if _COMPRESSED_OUTPUT is not None:
+        _COMPRESSED_OUTPUT.close()
+        _COMPRESSED_OUTPUT = None
+
+
+def lock():
+    """Returns the lock that guards both the output and any shared state
+    dict. Hold it while modifying bookmarks."""
+    return _WRITER.lock
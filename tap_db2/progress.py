@@ -0,0 +1,176 @@
+"""Estimates how much each stream has to sync and reports progress against
+the estimates.
+
+Estimated row counts and data sizes of the selected tables are read from
+qsys2.systablestat in a single query before syncing. They are used to sync
+the largest tables first, so that a big table started last doesn't hold up
+the end of a run, and to log rows per second, percentage complete and an ETA
+for each stream and for the whole run at every checkpoint.
+
+Only streams that read their whole table have a meaningful estimate, so
+incremental streams resuming from a bookmark count towards the rows per
+second but not towards the percentage complete or ETA."""
+import threading
+from collections import namedtuple
+from time import perf_counter
+import singer
+from . import timings
+from .common import get_cursor
+
+LOGGER = singer.get_logger()
+
+Estimate = namedtuple("Estimate", ["rows", "bytes"])
+
+STREAM_ORDERS = {"catalog", "largest_first"}
+
+
+def enabled(config):
+    return (bool(config.get("report_progress"))
+            or config.get("stream_order", "catalog") != "catalog")
+
+
+def query_estimates(config, catalog_entries):
+    """Returns a dict of tap_stream_ids to Estimates. Tables without
+    statistics, like views, are left out."""
+    schemas = sorted({e.database for e in catalog_entries})
+    if not schemas:
+        return {}
+    # Naming every table would take two bindings per table, so only the
+    # schemas are bound and the tables are picked out of the results.
+    with get_cursor(config) as cursor:
+        cursor.execute("""SELECT table_schema,
+                                 table_name,
+                                 SUM(number_rows),
+                                 SUM(data_size)
+                            FROM qsys2.systablestat
+                           WHERE table_schema IN ({})
+                           GROUP BY table_schema, table_name""".format(
+                               ",".join("?" * len(schemas))), schemas)
+        by_table = {(schema.strip(), table.strip()):
+                    Estimate(int(rows or 0), int(size or 0))
+                    for schema, table, rows, size in cursor.fetchall()}
+    return {e.tap_stream_id: by_table[(e.database, e.table)]
+            for e in catalog_entries if (e.database, e.table) in by_table}
+
+
+def order_streams(config, catalog_entries, estimates):
+    """Returns the catalog entries in the order they should be synced."""
+    order = config.get("stream_order", "catalog")
+    if order not in STREAM_ORDERS:
+        raise Exception("Unknown stream_order {}, expected one of {}".format(
+            order, ", ".join(sorted(STREAM_ORDERS))))
+    if order == "catalog":
+        return list(catalog_entries)
+    # Tables without an estimate go last, keeping their catalog order.
+    return sorted(catalog_entries,
+                  key=lambda e: estimates.get(e.tap_stream_id,
+                                              Estimate(-1, -1))[::-1],
+                  reverse=True)
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{:d}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def _describe(rows, elapsed, expected):
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    if not expected:
+        return "{} rows, {:.0f} rows/sec".format(rows, rate)
+    # Statistics lag behind the table, so the estimate can be exceeded.
+    remaining = max(expected - rows, 0)
+    eta = remaining / rate if rate > 0 else None
+    return "{} of ~{} rows ({:.1f}%), {:.0f} rows/sec, ETA {}".format(
+        rows, expected, min(100.0 * rows / expected, 100.0), rate,
+        _format_eta(eta))
+
+
+class RunProgress(object):
+    def __init__(self, estimates):
+        self.estimates = estimates
+        self.started = perf_counter()
+        # tap_stream_ids of the streams started so far, with the rows they
+        # are expected to sync, or None if that isn't known.
+        self.expected = {}
+        self._lock = threading.Lock()
+
+    def start_stream(self, tap_stream_id, reads_whole_table):
+        estimate = self.estimates.get(tap_stream_id)
+        with self._lock:
+            self.expected[tap_stream_id] = (estimate.rows if estimate and
+                                            reads_whole_table else None)
+
+    def _rows(self, tap_stream_id):
+        stream_timings = timings.get(tap_stream_id)
+        return stream_timings.rows if stream_timings else 0
+
+    def report(self, tap_stream_id):
+        """Logs the progress of a stream and of the whole run."""
+        stream_timings = timings.get(tap_stream_id)
+        if stream_timings is None:
+            return
+        with self._lock:
+            expected = dict(self.expected)
+        LOGGER.info("Progress of %s: %s", tap_stream_id, _describe(
+            stream_timings.rows, perf_counter() - stream_timings.started,
+            expected.get(tap_stream_id)))
+        # Streams that haven't started yet are expected to read their whole
+        # table.
+        total_expected = sum(rows for rows in expected.values() if rows)
+        total_expected += sum(estimate.rows for stream, estimate
+                              in self.estimates.items()
+                              if stream not in expected)
+        rows = sum(self._rows(stream) for stream in expected)
+        # Rows of streams without an estimate would push the run past 100%.
+        rows_estimated = sum(self._rows(stream) for stream, stream_rows
+                             in expected.items() if stream_rows)
+        elapsed = perf_counter() - self.started
+        if total_expected:
+            rate = rows / elapsed if elapsed > 0 else 0.0
+            remaining = max(total_expected - rows_estimated, 0)
+            eta = remaining / rate if rate > 0 else None
+            LOGGER.info("Progress of run: %d of ~%d rows (%.1f%%), %.0f "
+                        "rows/sec, ETA %s", rows_estimated, total_expected,
+                        min(100.0 * rows_estimated / total_expected, 100.0),
+                        rate, _format_eta(eta))
+        else:
+            LOGGER.info("Progress of run: %s", _describe(rows, elapsed, None))
+
+
+class _NoProgress(object):
+    def start_stream(self, tap_stream_id, reads_whole_table):
+        pass
+
+    def report(self, tap_stream_id):
+        pass
+
+
+_RUN = _NoProgress()
+
+
+def start_run(config, catalog_entries):
+    """Reads the estimates for a run's streams if progress reporting or
+    size-aware ordering is configured, and returns the streams in the order
+    they should be synced."""
+    global _RUN  # pylint: disable=global-statement
+    if not enabled(config):
+        _RUN = _NoProgress()
+        return list(catalog_entries)
+    estimates = query_estimates(config, catalog_entries)
+    LOGGER.info("Estimated %d rows and %d bytes to sync across %d tables",
+                sum(e.rows for e in estimates.values()),
+                sum(e.bytes for e in estimates.values()), len(estimates))
+    _RUN = RunProgress(estimates) if config.get("report_progress") \
+        else _NoProgress()
+    return order_streams(config, catalog_entries, estimates)
+
+
+def start_stream(tap_stream_id, reads_whole_table):
+    _RUN.start_stream(tap_stream_id, reads_whole_table)
+
+
+def report(tap_stream_id):
+    _RUN.report(tap_stream_id)
@@ -149,6 +149,39 @@ def build_state(raw_state, catalog):
                                               catalog_entry.tap_stream_id,
                                               'replication_key_value',
                                               raw_replication_key_value)
+                raw_replication_key_pk = singer.get_bookmark(raw_state,
+                                                             catalog_entry.tap_stream_id,
+                                                             'replication_key_pk')
+                if raw_replication_key_pk is not None:
+                    state = singer.write_bookmark(state,
+                                                  catalog_entry.tap_stream_id,
+                                                  'replication_key_pk',
+                                                  raw_replication_key_pk)
+
+        # Keep the position of an interrupted full table sync so it can be
+        # resumed. It is only meaningful alongside the version below.
+        for key in ('last_pk_fetched', 'partitions'):
+            raw_position = singer.get_bookmark(raw_state,
+                                               catalog_entry.tap_stream_id,
+                                               key)
+            if not replication_key and raw_position:
+                state = singer.write_bookmark(state,
+                                              catalog_entry.tap_stream_id,
+                                              key,
+                                              raw_position)
+
+        # Keep the journal position of a LOG_BASED stream, and whether its
+        # initial full table sync has finished.
+        if catalog_metadata.get((), {}).get('replication-method') == 'LOG_BASED':
+            for key in ('journal_sequence', 'initial_full_table_complete'):
+                raw_position = singer.get_bookmark(raw_state,
+                                                   catalog_entry.tap_stream_id,
+                                                   key)
+                if raw_position is not None:
+                    state = singer.write_bookmark(state,
+                                                  catalog_entry.tap_stream_id,
+                                                  key,
+                                                  raw_position)
 
         # Persist any existing version, even if it's None
         if raw_state.get('bookmarks', {}).get(catalog_entry.tap_stream_id):
@@ -0,0 +1,195 @@
+"""Runs the tap as a long-lived process that syncs jobs as they arrive.
+
+Starting the tap for every small incremental sync pays for starting Python,
+setting up the port configuration, signing on to the host and parsing the
+catalog each time. In server mode that is done once: the catalog is parsed
+at startup and connections are kept in the pool between jobs.
+
+A job is a JSON object with the state to start from and, optionally, the
+tap_stream_ids of the streams to sync, which default to every selected
+stream:
+
+    {"state": {...}, "streams": ["SCHEMA-TABLE"]}
+
+Jobs are read from a Unix socket at server_socket, one per connection as a
+single line, with the Singer messages written back over the connection, and
+from JSON files dropped into server_spool_dir, with the messages written to
+a file next to the job. Jobs run one at a time."""
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
+import singer
+from singer import utils
+from singer.catalog import Catalog
+from . import common, export, output, resolve, sync, timings
+
+LOGGER = singer.get_logger()
+
+REQUIRED_CONFIG_KEYS = ["host", "user", "password"]
+DEFAULT_POLL_SECONDS = 1.0
+
+# Spool file extensions. Jobs are picked up from .json files, which are
+# renamed to .done or .failed once run. Output is written to a temporary
+# .tmp file and renamed to .out once the job has finished, so a complete .out
+# file can be told apart from one that is still being written.
+JOB_SUFFIX = ".json"
+OUTPUT_SUFFIX = ".out"
+DONE_SUFFIX = ".done"
+FAILED_SUFFIX = ".failed"
+
+
+def _select_streams(catalog, streams):
+    if streams is None:
+        return catalog
+    by_id = {entry.tap_stream_id: entry for entry in catalog.streams}
+    unknown = [s for s in streams if s not in by_id]
+    if unknown:
+        raise Exception("Unknown streams in job: {}".format(
+            ", ".join(unknown)))
+    return Catalog([by_id[s] for s in streams])
+
+
+def run_job(config, catalog, job, out):
+    """Syncs the streams of a job, writing the Singer messages to out."""
+    input_catalog = _select_streams(catalog, job.get("streams"))
+    state = resolve.build_state(job.get("state") or {}, input_catalog)
+    resolved = resolve.resolve_catalog(input_catalog, input_catalog, state)
+    timings.reset()
+    output.configure(config, out)
+    try:
+        sync.sync(config, state, resolved)
+    finally:
+        output.close()
+        output.set_writer(output.MessageWriter())
+
+
+def _handle_connection(config, catalog, conn):
+    with conn, conn.makefile("r", encoding="utf-8") as rfile, \
+            conn.makefile("w", encoding="utf-8") as wfile:
+        line = rfile.readline()
+        if not line.strip():
+            return
+        job = json.loads(line)
+        LOGGER.info("Running job from %s", config["server_socket"])
+        run_job(config, catalog, job, wfile)
+
+
+def _spooled_jobs(spool_dir):
+    return sorted(name for name in os.listdir(spool_dir)
+                  if name.endswith(JOB_SUFFIX))
+
+
+def process_spool(config, catalog, spool_dir):
+    """Runs every job waiting in the spool directory, in order of name."""
+    for name in _spooled_jobs(spool_dir):
+        base = os.path.join(spool_dir, name[:-len(JOB_SUFFIX)])
+        job_path = base + JOB_SUFFIX
+        LOGGER.info("Running job %s", job_path)
+        out = tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=spool_dir,
+            prefix=os.path.basename(base) + OUTPUT_SUFFIX + ".",
+            suffix=".tmp", delete=False)
+        try:
+            with out:
+                with open(job_path) as f:
+                    job = json.load(f)
+                run_job(config, catalog, job, out)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.error("Job %s failed", job_path, exc_info=exc)
+            os.remove(out.name)
+            os.replace(job_path, base + FAILED_SUFFIX)
+            continue
+        os.replace(out.name, base + OUTPUT_SUFFIX)
+        os.replace(job_path, base + DONE_SUFFIX)
+
+
+def _listen(path):
+    if os.path.exists(path):
+        # Left behind by a server that didn't shut down cleanly.
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The socket is created with the umask's permissions, so it is only
+    # ever reachable by the server's user.
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen()
+    return sock
+
+
+def serve(config, catalog, stopped=None):
+    """Runs jobs from server_socket and server_spool_dir until stopped is
+    set."""
+    stopped = stopped or threading.Event()
+    poll_seconds = float(config.get("server_poll_seconds",
+                                    DEFAULT_POLL_SECONDS))
+    socket_path = config.get("server_socket")
+    spool_dir = config.get("server_spool_dir")
+    if not socket_path and not spool_dir:
+        raise Exception("server_socket or server_spool_dir is required to "
+                        "run the server")
+    sock = _listen(socket_path) if socket_path else None
+    LOGGER.info("Serving %d streams", len(catalog.streams))
+    try:
+        while not stopped.is_set():
+            if spool_dir:
+                process_spool(config, catalog, spool_dir)
+            if sock is None:
+                stopped.wait(poll_seconds)
+                continue
+            sock.settimeout(poll_seconds)
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            try:
+                _handle_connection(config, catalog, conn)
+            except Exception as exc:  # pylint: disable=broad-except
+                # The client sees its output end early.
+                LOGGER.error("Job from %s failed", socket_path, exc_info=exc)
+    finally:
+        if sock is not None:
+            sock.close()
+            os.unlink(socket_path)
+
+
+def _server_config(config):
+    config = dict(config)
+    # Output goes back to the client, so it can't be redirected elsewhere.
+    for key in ("output_compression", "output_file"):
+        if config.pop(key, None):
+            LOGGER.warning("Ignoring %s in server mode", key)
+    return config
+
+
+def main_impl():
+    args = utils.parse_args(REQUIRED_CONFIG_KEYS)
+    config = _server_config(args.config)
+    if args.catalog:
+        catalog = args.catalog
+    elif args.properties:
+        catalog = Catalog.from_dict(args.properties)
+    else:
+        raise Exception("A catalog is required to run the server")
+    export.check_config(config)
+    common.setup_port_configuration(config)
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stopped.set())
+    serve(config, catalog, stopped)
+
+
+def main():
+    try:
+        main_impl()
+    except Exception as exc:
+        LOGGER.critical("unknown top-level tap exception", exc_info=exc)
+        raise
+    finally:
+        common.close_pools()
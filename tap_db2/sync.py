@@ -1,13 +1,21 @@
-from datetime import datetime, date, time
-from time import time as time_
-from collections import namedtuple
+import contextlib
+import queue
+import sys
+import threading
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+from time import time as time_, monotonic, perf_counter
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import pendulum
 import singer
 import singer.metrics as metrics
-from singer.catalog import CatalogEntry
-from singer import write_message as _emit
+from singer.catalog import Catalog, CatalogEntry
 from singer import metadata
+from . import encoder, export, journal, output, progress, timings
 from .common import get_cursor
+from .discovery import schemas
+from .output import write_message as _emit
 
 LOGGER = singer.get_logger()
 _get_bk = singer.get_bookmark
@@ -15,6 +23,36 @@ _set_bk = singer.write_bookmark
 
 ReplicationKey = namedtuple("ReplicationKey", ["column", "value"])
 
+DEFAULT_FETCH_MEMORY_BUDGET_MB = 32
+DEFAULT_FULL_TABLE_PAGE_SIZE = 100000
+DEFAULT_CHECKPOINT_INTERVAL_ROWS = 1000
+PARTITION_SAMPLES_PER_PARTITION = 100
+MAX_FETCH_BATCH_SIZE = 50000
+SDC_DELETED_AT = "_sdc_deleted_at"
+INITIAL_WINDOW_COUNT = 100
+ISOLATION_LEVELS = {"NC", "UR", "CS", "RS", "RR"}
+# Config keys of query hints and the stream metadata that overrides them.
+_HINT_METADATA = {
+    "isolation_level": "isolation-level",
+    "optimize_for_rows": "optimize-for-rows",
+    "fetch_block_size_kb": "fetch-block-size-kb",
+}
+MAX_WINDOW_GROWTH = 4
+
+# Approximate size in bytes of the Python object pyodbc builds for a value of
+# each type. Character types are sized from their maximum length instead.
+_BYTES_FOR_VALUE = {
+    "integer": 28,
+    "float": 24,
+    "decimal": 104,
+    "date": 32,
+    "time": 40,
+    "timestmp": 48,
+}
+_BYTES_FOR_STRING = 49
+_DEFAULT_STRING_LENGTH = 256
+_DEFAULT_BYTES_FOR_VALUE = 64
+
 
 def _quote(x):
     return '"{}"'.format(x.replace('"', '""'))
@@ -36,9 +74,51 @@ def _get_replication_key(state: dict, catalog_entry: CatalogEntry):
     value = _get_bk(state, tap_stream_id, "replication_key_value")
     if value and _is_datetime_col(catalog_entry, column):
         value = pendulum.parse(value)
+    elif _sql_data_type(catalog_entry, column) in schemas.DECIMAL_TYPES:
+        value = _parse_bookmark_value(catalog_entry, column, value)
     return ReplicationKey(column, value)
 
 
+def _parse_bookmark_value(catalog_entry, column, value):
+    """Turns a value read back from a bookmark, which holds the value as it
+    was emitted in a record, into a value that can be bound to a query."""
+    if value is None:
+        return value
+    if _sql_data_type(catalog_entry, column) in schemas.DECIMAL_TYPES:
+        # Bookmarks written before decimals were kept as strings hold
+        # floats, whose exact binary value has far more digits.
+        return Decimal(str(value))
+    if not _is_datetime_col(catalog_entry, column):
+        return value
+    parsed = pendulum.parse(value)
+    data_type = _sql_data_type(catalog_entry, column)
+    if data_type == "date":
+        return parsed.date()
+    if data_type == "time":
+        return parsed.time()
+    return parsed
+
+
+def _bookmark_value(value):
+    # Decimals are kept as strings, since the state is read back as JSON
+    # and would otherwise turn them into floats.
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _key_properties(catalog_entry):
+    mdata = metadata.to_map(catalog_entry.metadata).get((), {})
+    if catalog_entry.is_view:
+        return mdata.get('view-key-properties', [])
+    return mdata.get('table-key-properties', [])
+
+
+def _replication_method(catalog_entry):
+    mdata = metadata.to_map(catalog_entry.metadata).get((), {})
+    return mdata.get("replication-method")
+
+
 def _sql_data_type(catalog_entry, column):
     return metadata.get(metadata.to_map(catalog_entry.metadata),
                         breadcrumb=("properties", column),
@@ -56,42 +136,312 @@ def _column_sql(catalog_entry: CatalogEntry, column: str):
     return _quote(column)
 
 
-def _create_sql(catalog_entry: CatalogEntry, columns, rep_key: ReplicationKey):
-    escaped_columns = [_column_sql(catalog_entry, c) for c in columns]
-    select = "SELECT {} FROM {}.{}".format(
-        ",".join(escaped_columns),
-        _quote(catalog_entry.database),
-        _quote(catalog_entry.table))
+# Expressions that format a temporal column the way _format_datetime,
+# _format_date and _format_time do, for server_temporal_formatting.
+_SERVER_FORMATS = {
+    "timestmp": ("REPLACE(CASE WHEN MICROSECOND({0}) = 0"
+                 " THEN VARCHAR_FORMAT({0}, 'YYYY-MM-DD HH24:MI:SS')"
+                 " ELSE VARCHAR_FORMAT({0}, 'YYYY-MM-DD HH24:MI:SS.NNNNNN')"
+                 " END, ' ', 'T') || '+00:00'"),
+    "date": "CHAR({0}, ISO) || 'T00:00:00+00:00'",
+    "time": "'1970-01-01T' || CHAR({0}, JIS) || '+00:00'",
+}
+
+
+def _server_format(config):
+    # Exported files hold typed values rather than text.
+    return (bool(config.get("server_temporal_formatting"))
+            and not export.enabled(config))
+
+
+def _select_column_sql(catalog_entry, column, server_format):
+    col_sql = _column_sql(catalog_entry, column)
+    if server_format:
+        data_type = _sql_data_type(catalog_entry, column)
+        if data_type in _SERVER_FORMATS:
+            return _SERVER_FORMATS[data_type].format(col_sql)
+    return col_sql
+
+
+def _select_sql(catalog_entry: CatalogEntry, columns, with_rrn=False,
+                server_format=False):
+    """Returns the SELECT and FROM clauses of an extraction query. With
+    server_format, temporal columns are selected as the text they are
+    emitted as."""
+    escaped_columns = [_select_column_sql(catalog_entry, c, server_format)
+                       for c in columns]
+    table = "{}.{}".format(_quote(catalog_entry.database),
+                           _quote(catalog_entry.table))
+    if with_rrn:
+        # The relative record number is selected after every column, so it
+        # is dropped when the row is zipped up with the column names.
+        escaped_columns.append("RRN(T)")
+        table += " T"
+    return "SELECT {} FROM {}".format(",".join(escaped_columns), table)
+
+
+def _order_by_sql(columns):
+    return " ORDER BY {}".format(", ".join("{} ASC".format(_quote(c))
+                                           for c in columns))
+
+
+def _create_sql(catalog_entry: CatalogEntry, columns, rep_key: ReplicationKey,
+                tie_columns=(), position=None, server_format=False):
+    """Returns SQL and params selecting rows in replication key order. If
+    position holds the replication key and tie_columns values of the last
+    row written, only rows strictly after it are selected; otherwise rows
+    from the replication key value on are."""
+    select = _select_sql(catalog_entry, columns, server_format=server_format)
     params = ()
     if not rep_key:
         return select, params
-    if rep_key.value is not None:
+    if position is not None:
+        predicate, params = _keyset_predicate(
+            catalog_entry, [rep_key.column] + list(tie_columns), position)
+        select += " WHERE {}".format(predicate)
+    elif rep_key.value is not None:
         col_sql = _quote(rep_key.column)
         if _is_timestamp_column(catalog_entry, rep_key.column):
             col_sql += " - CURRENT TIMEZONE"
         select += " WHERE {} >= ?".format(col_sql)
         params = (rep_key.value,)
-    select += " ORDER BY {} ASC".format(_quote(rep_key.column))
+    select += _order_by_sql([rep_key.column] + list(tie_columns))
+    return select, params
+
+
+def _keyset_predicate(catalog_entry, key_columns, key_values):
+    """Returns SQL and params matching rows whose key sorts strictly after
+    key_values, i.e. (a, b) > (?, ?) written out as
+    a > ? OR (a = ? AND b > ?), which DB2 for i can use an index for."""
+    clauses = []
+    params = []
+    for i, column in enumerate(key_columns):
+        terms = ["{} = ?".format(_column_sql(catalog_entry, c))
+                 for c in key_columns[:i]]
+        terms.append("{} > ?".format(_column_sql(catalog_entry, column)))
+        clauses.append("({})".format(" AND ".join(terms)))
+        params.extend(key_values[:i + 1])
+    return "({})".format(" OR ".join(clauses)), tuple(params)
+
+
+def _create_keyset_sql(catalog_entry, columns, key_columns, key_values,
+                       page_size, bounds=None, server_format=False):
+    """Returns SQL and params selecting the next page of a full table sync
+    in primary key order, starting after key_values if it is set. bounds is
+    an optional (sql, params) pair of additional predicates."""
+    select = _select_sql(catalog_entry, columns, server_format=server_format)
+    predicates = []
+    params = ()
+    if bounds:
+        predicates.append(bounds[0])
+        params += tuple(bounds[1])
+    if key_values is not None:
+        predicate, key_params = _keyset_predicate(catalog_entry, key_columns,
+                                                  key_values)
+        predicates.append(predicate)
+        params += key_params
+    if predicates:
+        select += " WHERE " + " AND ".join(predicates)
+    select += " ORDER BY {} FETCH FIRST {} ROWS ONLY".format(
+        ", ".join("{} ASC".format(_quote(c)) for c in key_columns),
+        int(page_size))
     return select, params
 
 
-def _row_to_record(catalog_entry, version, row, columns):
-    row_to_persist = ()
-    for elem in row:
-        if isinstance(elem, datetime):
-            row_to_persist += (elem.isoformat() + "+00:00",)
-        elif isinstance(elem, date):
-            row_to_persist += (elem.isoformat() + "T00:00:00+00:00",)
-        elif isinstance(elem, time):
-            epoch = datetime.utcfromtimestamp(0)
-            epoch_with_time = datetime.combine(epoch.date(), elem)
-            row_to_persist += (epoch_with_time.isoformat() + "+00:00",)
+def _create_rrn_sql(catalog_entry, columns, last_rrn, upper_rrn, page_size,
+                    server_format=False):
+    """Returns SQL and params selecting the next page of rows by relative
+    record number, for tables without a primary key."""
+    select = _select_sql(catalog_entry, columns, with_rrn=True,
+                         server_format=server_format)
+    select += (" WHERE RRN(T) > ? AND RRN(T) <= ?"
+               " ORDER BY RRN(T) FETCH FIRST {} ROWS ONLY").format(int(page_size))
+    return select, (last_rrn, upper_rrn)
+
+
+def _format_datetime(value):
+    return value.isoformat() + "+00:00"
+
+
+def _format_date(value):
+    return value.isoformat() + "T00:00:00+00:00"
+
+
+def _format_time(value):
+    # TIME values are emitted as a time on the epoch date.
+    return "1970-01-01T" + value.isoformat() + "+00:00"
+
+
+def _format_any(value):
+    if isinstance(value, datetime):
+        return _format_datetime(value)
+    if isinstance(value, date):
+        return _format_date(value)
+    if isinstance(value, time):
+        return _format_time(value)
+    return value
+
+
+_CONVERTERS = {
+    "timestmp": _format_datetime,
+    "date": _format_date,
+    "time": _format_time,
+}
+_PASSTHROUGH_TYPES = (set(schemas.BYTES_FOR_INTEGER_TYPE)
+                      | schemas.FLOAT_TYPES
+                      | schemas.DECIMAL_TYPES
+                      | schemas.STRING_TYPES)
+
+
+def _compile_converters(catalog_entry, columns, server_format=False):
+    """Returns a list of (index, function) pairs for the columns whose values
+    need converting before they can be emitted. Values of every other column
+    are passed through as they are, as are temporal values that were
+    formatted by the server."""
+    converters = []
+    for i, column in enumerate(columns):
+        data_type = _sql_data_type(catalog_entry, column)
+        if data_type in _PASSTHROUGH_TYPES:
+            continue
+        if server_format and data_type in _SERVER_FORMATS:
+            continue
+        converters.append((i, _CONVERTERS.get(data_type, _format_any)))
+    return converters
+
+
+def _convert_row(converters, row):
+    values = list(row)
+    for i, convert in converters:
+        value = values[i]
+        if value is not None:
+            values[i] = convert(value)
+    return values
+
+
+def _row_to_record(row, columns, converters):
+    return dict(zip(columns, _convert_row(converters, row)))
+
+
+def _set_bookmark(state, tap_stream_id, key, val):
+    # Other streams' workers may be serializing the state concurrently.
+    with output.lock():
+        return _set_bk(state, tap_stream_id, key, val)
+
+
+def _estimate_value_width(catalog_entry, column):
+    data_type = _sql_data_type(catalog_entry, column)
+    if data_type in schemas.BYTES_FOR_INTEGER_TYPE:
+        return _BYTES_FOR_VALUE["integer"]
+    if data_type in schemas.FLOAT_TYPES:
+        return _BYTES_FOR_VALUE["float"]
+    if data_type in schemas.DECIMAL_TYPES:
+        return _BYTES_FOR_VALUE["decimal"]
+    if data_type in schemas.STRING_TYPES:
+        max_length = catalog_entry.schema.properties[column].maxLength
+        return _BYTES_FOR_STRING + (max_length or _DEFAULT_STRING_LENGTH)
+    return _BYTES_FOR_VALUE.get(data_type, _DEFAULT_BYTES_FOR_VALUE)
+
+
+def _estimate_row_width(catalog_entry, columns):
+    """Estimates how many bytes of memory a single fetched row will take up,
+    based on the discovered column types."""
+    row_overhead = sys.getsizeof(()) + 8 * len(columns)
+    return row_overhead + sum(_estimate_value_width(catalog_entry, c)
+                              for c in columns)
+
+
+def _measure_row_width(rows):
+    sample = rows[:100]
+    total = sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+                for row in sample)
+    return total // len(sample)
+
+
+def _fetch_batch_size(config, row_width):
+    budget_mb = config.get("fetch_memory_budget_mb",
+                           DEFAULT_FETCH_MEMORY_BUDGET_MB)
+    budget = int(float(budget_mb) * 1024 * 1024)
+    return max(1, min(MAX_FETCH_BATCH_SIZE, budget // max(row_width, 1)))
+
+
+def _read_batches(config, cursor, catalog_entry, columns):
+    estimated_width = _estimate_row_width(catalog_entry, columns)
+    batch_size = _fetch_batch_size(config, estimated_width)
+    cursor.arraysize = batch_size
+    rows = cursor.fetchmany(batch_size)
+    if not rows:
+        return
+    measured_width = _measure_row_width(rows)
+    batch_size = _fetch_batch_size(config, measured_width)
+    cursor.arraysize = batch_size
+    LOGGER.info("Fetching %s.%s in batches of %d rows "
+                "(estimated %d bytes/row, measured %d bytes/row)",
+                catalog_entry.database, catalog_entry.table, batch_size,
+                estimated_width, measured_width)
+    while rows:
+        yield rows
+        rows = cursor.fetchmany(batch_size)
+
+
+# Queue items that end a prefetched sequence of batches, carrying the
+# exception the fetching thread raised, if any.
+_EndOfBatches = namedtuple("_EndOfBatches", ["error"])
+
+
+def _prefetch(batches, depth):
+    """Yields the batches of an iterator, which are fetched ahead on a
+    thread of their own, up to depth batches at a time. pyodbc releases the
+    GIL while it waits on the server, so fetching the next batches overlaps
+    with converting and writing the current one."""
+    batch_queue = queue.Queue(depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+        except Exception as exc:  # pylint: disable=broad-except
+            put(_EndOfBatches(exc))
         else:
-            row_to_persist += (elem,)
-    return singer.RecordMessage(
-        stream=catalog_entry.stream,
-        record=dict(zip(columns, row_to_persist)),
-        version=version)
+            put(_EndOfBatches(None))
+
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batch_queue.get()
+            if isinstance(item, _EndOfBatches):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+    finally:
+        # The cursor may only be used again once the thread is done with it.
+        stopped.set()
+        thread.join()
+
+
+def _fetch_batches(config, cursor, catalog_entry, columns):
+    """Yields lists of rows from an executed cursor. The size of each batch
+    is chosen so that a batch stays within the configured memory budget,
+    first from the estimated row width and then, once the first batch has
+    been fetched, from the measured one. With fetch_queue_depth set,
+    batches are fetched ahead of the rows being written."""
+    batches = _read_batches(config, cursor, catalog_entry, columns)
+    depth = int(config.get("fetch_queue_depth", 0))
+    if depth > 0:
+        return _prefetch(batches, depth)
+    return batches
 
 
 def _write_metrics(catalog_entry, rows_saved):
@@ -127,10 +477,745 @@ def _maybe_activate_after_sync(state, catalog_entry, rep_key, stream_version):
     if not rep_key:
         _activate_version(catalog_entry, stream_version)
         tap_stream_id = catalog_entry.tap_stream_id
-        state = _set_bk(state, tap_stream_id, "version", None)
+        with output.lock():
+            state = _set_bk(state, tap_stream_id, "version", None)
+            state["bookmarks"][tap_stream_id].pop("last_pk_fetched", None)
+            state["bookmarks"][tap_stream_id].pop("partitions", None)
     return state
 
 
+def _hints_sql(config):
+    """Returns the optimizer goal and isolation clauses to append to an
+    extraction query."""
+    hints = ""
+    if config.get("optimize_for_rows"):
+        hints += " OPTIMIZE FOR {} ROWS".format(int(config["optimize_for_rows"]))
+    if config.get("isolation_level"):
+        hints += " WITH {}".format(config["isolation_level"])
+    return hints
+
+
+def _stream_config(config, catalog_entry):
+    """Returns the config for syncing a stream, with any query hints set in
+    the stream's metadata taking the place of the global ones."""
+    mdata = metadata.to_map(catalog_entry.metadata).get((), {})
+    stream_config = dict(config)
+    for key, metadata_key in _HINT_METADATA.items():
+        if mdata.get(metadata_key) is not None:
+            stream_config[key] = mdata[metadata_key]
+    isolation_level = stream_config.get("isolation_level")
+    if isolation_level:
+        isolation_level = str(isolation_level).upper()
+        if isolation_level not in ISOLATION_LEVELS:
+            raise Exception("Unknown isolation level {} for {}".format(
+                isolation_level, catalog_entry.tap_stream_id))
+        stream_config["isolation_level"] = isolation_level
+    return stream_config
+
+
+def _execute(config, cursor, catalog_entry, select, params):
+    select += _hints_sql(config)
+    LOGGER.info("Running %s PARAMS (%s)", select, params)
+    started = perf_counter()
+    cursor.execute(select, params)
+    timings.get(catalog_entry.tap_stream_id).add("execute",
+                                                 perf_counter() - started)
+
+
+class _Checkpoint(object):
+    """Decides when a stream should write a STATE message: after a number of
+    rows, seconds or bytes of output since the last one, whichever comes
+    first. A limit of 0 disables that condition."""
+    def __init__(self, config):
+        self.max_rows = int(config.get("checkpoint_interval_rows",
+                                       DEFAULT_CHECKPOINT_INTERVAL_ROWS))
+        self.max_seconds = float(config.get("checkpoint_interval_seconds", 0))
+        self.max_bytes = int(config.get("checkpoint_interval_bytes", 0))
+        self.reset()
+
+    def reset(self):
+        self.rows = 0
+        self.bytes = 0
+        self.started = monotonic()
+
+    def due(self, size, rows=1):
+        """Counts rows taking up size bytes and returns whether a checkpoint
+        is due."""
+        self.rows += rows
+        self.bytes += size
+        return ((self.max_rows and self.rows >= self.max_rows)
+                or (self.max_bytes and self.bytes >= self.max_bytes)
+                or (self.max_seconds
+                    and monotonic() - self.started >= self.max_seconds))
+
+
+def _export_rows(config, state, cursor, catalog_entry, columns, converters,
+                 stream_version, update_bookmarks, rows_saved):
+    """Writes the rows of an executed cursor to the stream's export files.
+    The bookmarks are only moved to a row once the file it went into is
+    closed."""
+    stream_timings = timings.get(catalog_entry.tap_stream_id)
+    exporter = export.get(config, catalog_entry, columns, stream_version)
+    last_row = None
+    with contextlib.closing(_fetch_batches(config, cursor, catalog_entry,
+                                           columns)) as batches:
+        while True:
+            fetch_started = perf_counter()
+            rows = next(batches, None)
+            if rows is None:
+                break
+            started = perf_counter()
+            stream_timings.add("fetch", started - fetch_started)
+            stream_timings.first_row()
+            last_row = rows[-1]
+            last_record = _row_to_record(last_row, columns, converters)
+            exporter.write(rows, export.bookmark_on_close(
+                state, update_bookmarks, last_record, last_row))
+            stream_timings.add_rows(len(rows), 0.0, 0.0,
+                                    perf_counter() - started)
+            rows_saved += len(rows)
+    return rows_saved, last_row
+
+
+def _encode_rows(stream, stream_version, columns, converters, rows):
+    """Returns the RECORD messages for a batch of rows as one block of text.
+    Runs on an encoding worker process."""
+    return "".join(output.encode_record(stream, stream_version,
+                                        _row_to_record(row, columns,
+                                                       converters))
+                   for row in rows)
+
+
+def _encode_rows_in_pool(config, state, cursor, catalog_entry, columns,
+                         converters, stream_version, update_bookmarks,
+                         rows_saved, checkpoint):
+    """Writes the rows of an executed cursor like _sync_rows, but has them
+    converted and encoded on the encoding worker processes. Blocks are
+    written in the order their batches were fetched, and checkpoints are
+    only written between blocks."""
+    stream = catalog_entry.stream
+    stream_timings = timings.get(catalog_entry.tap_stream_id)
+    pool = encoder.get_pool(config)
+    pending = deque()
+    last_row = None
+
+    def write_block():
+        future, rows = pending.popleft()
+        started = perf_counter()
+        block = future.result()
+        encoded = perf_counter()
+        size = output.write_line(block)
+        stream_timings.add_rows(len(rows), 0.0, encoded - started,
+                                perf_counter() - encoded)
+        if checkpoint.due(size, len(rows)):
+            with output.lock():
+                update_bookmarks(state, _row_to_record(rows[-1], columns,
+                                                       converters),
+                                 rows[-1])
+                output.write_state(state)
+            progress.report(catalog_entry.tap_stream_id)
+            checkpoint.reset()
+        return len(rows)
+
+    try:
+        with contextlib.closing(_fetch_batches(config, cursor, catalog_entry,
+                                               columns)) as batches, \
+                timings.sampler(config, stream_timings):
+            while True:
+                fetch_started = perf_counter()
+                rows = next(batches, None)
+                if rows is None:
+                    break
+                stream_timings.add("fetch", perf_counter() - fetch_started)
+                stream_timings.first_row()
+                # Driver row objects can't be pickled, so they are sent to
+                # the workers as tuples.
+                rows = [tuple(row) for row in rows]
+                pending.append((pool.submit(_encode_rows, stream,
+                                            stream_version, columns,
+                                            converters, rows), rows))
+                last_row = rows[-1]
+                if len(pending) >= encoder.max_pending(config):
+                    rows_saved += write_block()
+            while pending:
+                rows_saved += write_block()
+    finally:
+        for future, _ in pending:
+            future.cancel()
+    if last_row is not None:
+        with output.lock():
+            update_bookmarks(state, _row_to_record(last_row, columns,
+                                                   converters), last_row)
+    return rows_saved, last_row
+
+
+def _sync_rows(config, state, cursor, catalog_entry, columns, converters,
+               stream_version, update_bookmarks, rows_saved=0,
+               checkpoint=None):
+    """Writes each row of an executed cursor as a RECORD message. The last
+    record and row written are kept locally, and update_bookmarks(state,
+    record, row) is only called with them when a checkpoint is written and
+    once all rows are done. Returns the running number of rows written and
+    the last row fetched."""
+    if export.enabled(config):
+        return _export_rows(config, state, cursor, catalog_entry, columns,
+                            converters, stream_version, update_bookmarks,
+                            rows_saved)
+    checkpoint = checkpoint or _Checkpoint(config)
+    if encoder.enabled(config):
+        return _encode_rows_in_pool(config, state, cursor, catalog_entry,
+                                    columns, converters, stream_version,
+                                    update_bookmarks, rows_saved, checkpoint)
+    stream = catalog_entry.stream
+    stream_timings = timings.get(catalog_entry.tap_stream_id)
+    last_record = last_row = None
+    with contextlib.closing(_fetch_batches(config, cursor, catalog_entry,
+                                           columns)) as batches, \
+            timings.sampler(config, stream_timings):
+        while True:
+            fetch_started = perf_counter()
+            rows = next(batches, None)
+            if rows is None:
+                break
+            started = perf_counter()
+            stream_timings.add("fetch", started - fetch_started)
+            stream_timings.first_row()
+            convert = encode = write = 0.0
+            for row in rows:
+                record = _row_to_record(row, columns, converters)
+                converted = perf_counter()
+                line = output.encode_record(stream, stream_version, record)
+                encoded = perf_counter()
+                size = output.write_line(line)
+                written = perf_counter()
+                convert += converted - started
+                encode += encoded - converted
+                write += written - encoded
+                started = written
+                last_record, last_row = record, row
+                if checkpoint.due(size):
+                    with output.lock():
+                        update_bookmarks(state, last_record, last_row)
+                        output.write_state(state)
+                    progress.report(catalog_entry.tap_stream_id)
+                    checkpoint.reset()
+                    started = perf_counter()
+            stream_timings.add_rows(len(rows), convert, encode, write)
+            rows_saved += len(rows)
+    if last_row is not None:
+        with output.lock():
+            update_bookmarks(state, last_record, last_row)
+    return rows_saved, last_row
+
+
+def _sync_pages(config, state, cursor, catalog_entry, columns, converters,
+                stream_version, update_bookmarks, next_page):
+    """Runs the query returned by next_page(last_row) and writes its rows
+    until a page comes back with fewer than full_table_page_size rows.
+    last_row is None for the first page."""
+    page_size = _full_table_page_size(config)
+    checkpoint = _Checkpoint(config)
+    rows_saved = 0
+    last_row = None
+    while True:
+        select, params = next_page(last_row, page_size)
+        _execute(config, cursor, catalog_entry, select, params)
+        page_start = rows_saved
+        rows_saved, last_row = _sync_rows(
+            config, state, cursor, catalog_entry, columns, converters,
+            stream_version, update_bookmarks, rows_saved, checkpoint)
+        if rows_saved - page_start < page_size:
+            return rows_saved
+
+
+def _full_table_page_size(config):
+    return int(config.get("full_table_page_size",
+                          DEFAULT_FULL_TABLE_PAGE_SIZE))
+
+
+def _tie_columns(rep_key, key_columns):
+    """Returns the primary key columns that break ties between rows with the
+    same replication key value, or None if the table has no primary key and
+    rows can't be told apart."""
+    if not rep_key or not key_columns:
+        return None
+    return [c for c in key_columns if c != rep_key.column]
+
+
+def _replication_position(state, catalog_entry, rep_key, tie_columns):
+    """Returns the replication key and tie_columns values of the last row
+    written, from the bookmarks, or None if the bookmarks don't hold all of
+    them."""
+    if rep_key is None or rep_key.value is None or tie_columns is None:
+        return None
+    last_pk = _get_bk(state, catalog_entry.tap_stream_id,
+                      "replication_key_pk")
+    if last_pk is None or set(last_pk) != set(tie_columns):
+        return None
+    return [rep_key.value] + [_parse_bookmark_value(catalog_entry, c,
+                                                    last_pk[c])
+                              for c in tie_columns]
+
+
+def _replication_bookmarks(tap_stream_id, rep_key, tie_columns):
+    """Returns an update_bookmarks function storing the replication key
+    value of the last row written and, if there are tie_columns, their
+    values as replication_key_pk."""
+    def update_bookmarks(state, record, row):
+        _set_bk(state, tap_stream_id, "replication_key_value",
+                _bookmark_value(record[rep_key.column]))
+        if tie_columns is not None:
+            _set_bk(state, tap_stream_id, "replication_key_pk",
+                    {c: _bookmark_value(record[c]) for c in tie_columns})
+    return update_bookmarks
+
+
+def _sync_incremental(config, state, cursor, catalog_entry, columns,
+                      converters, stream_version, rep_key, key_columns=()):
+    tap_stream_id = catalog_entry.tap_stream_id
+    tie_columns = _tie_columns(rep_key, key_columns)
+    position = _replication_position(state, catalog_entry, rep_key,
+                                     tie_columns)
+
+    if rep_key:
+        update_bookmarks = _replication_bookmarks(tap_stream_id, rep_key,
+                                                  tie_columns)
+    else:
+        def update_bookmarks(state, record, row):
+            pass
+
+    select, params = _create_sql(catalog_entry, columns, rep_key,
+                                 tie_columns or (), position,
+                                 _server_format(config))
+    _execute(config, cursor, catalog_entry, select, params)
+    rows_saved, _ = _sync_rows(config, state, cursor, catalog_entry, columns,
+                               converters, stream_version, update_bookmarks)
+    return rows_saved
+
+
+def _naive_value(catalog_entry, column, value):
+    """Turns a replication key value read from the state into a plain value
+    that can be compared with the values the column is fetched as."""
+    value = _parse_bookmark_value(catalog_entry, column, value)
+    if isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day, value.hour,
+                        value.minute, value.second, value.microsecond)
+    if isinstance(value, date):
+        return date(value.year, value.month, value.day)
+    return value
+
+
+def _scale_window(width, factor, whole_days=False):
+    """Multiplies a window width by factor, keeping it at least one unit of
+    the key's type wide so that windows always advance. DATE keys can only
+    advance by whole days."""
+    if whole_days:
+        return timedelta(days=max(1, round(width.days * factor)))
+    if isinstance(width, timedelta):
+        return max(width * factor, timedelta(seconds=1))
+    if isinstance(width, int):
+        return max(1, int(width * factor))
+    return max(width * Decimal(str(factor)), Decimal("0.000001"))
+
+
+def _next_window(width, rows, target_rows, whole_days=False):
+    """Sizes the next window so that it would hold about target_rows at the
+    row density seen in the last one, growing or shrinking it at most
+    MAX_WINDOW_GROWTH times."""
+    factor = target_rows / max(rows, 1)
+    factor = min(MAX_WINDOW_GROWTH, max(1.0 / MAX_WINDOW_GROWTH, factor))
+    return _scale_window(width, factor, whole_days)
+
+
+def _create_window_sql(catalog_entry, columns, column, tie_columns, start,
+                       end, last, position=None, server_format=False):
+    """Returns SQL and params selecting the rows of one window, from start,
+    or from just after position if it is set, to end."""
+    col_sql = _column_sql(catalog_entry, column)
+    select = _select_sql(catalog_entry, columns, server_format=server_format)
+    if position is not None:
+        predicate, params = _keyset_predicate(
+            catalog_entry, [column] + list(tie_columns), position)
+    else:
+        predicate, params = "{} >= ?".format(col_sql), (start,)
+    select += " WHERE {} AND {} {} ?".format(predicate, col_sql,
+                                             "<=" if last else "<")
+    select += _order_by_sql([column] + list(tie_columns))
+    return select, params + (end,)
+
+
+def _sync_incremental_windows(config, state, cursor, catalog_entry, columns,
+                              converters, stream_version, rep_key,
+                              window_rows, key_columns=()):
+    """Syncs an incremental stream in windows of the replication key, up to
+    its maximum value when the sync started, so that DB2 only has to sort
+    one window's rows at a time. The width of each window is adapted to the
+    number of rows the previous one held, and a STATE message is written
+    after each of them."""
+    tap_stream_id = catalog_entry.tap_stream_id
+    column = rep_key.column
+    cursor.execute("SELECT MIN({0}), MAX({0}) FROM {1}.{2}".format(
+        _column_sql(catalog_entry, column), _quote(catalog_entry.database),
+        _quote(catalog_entry.table)))
+    lowest, upper = cursor.fetchone()
+    if upper is None:
+        if rep_key.value is None:
+            return _sync_null_keys(config, state, cursor, catalog_entry,
+                                   columns, converters, stream_version,
+                                   column)
+        return 0
+    lower = lowest
+    if rep_key.value is not None:
+        lower = _naive_value(catalog_entry, column,
+                             _get_bk(state, tap_stream_id,
+                                     "replication_key_value"))
+
+    tie_columns = _tie_columns(rep_key, key_columns)
+    position = _replication_position(state, catalog_entry, rep_key,
+                                     tie_columns)
+    update_bookmarks = _replication_bookmarks(tap_stream_id, rep_key,
+                                              tie_columns)
+    whole_days = _sql_data_type(catalog_entry, column) == "date"
+    width = _scale_window(upper - lower, 1.0 / INITIAL_WINDOW_COUNT,
+                          whole_days)
+    checkpoint = _Checkpoint(config)
+    rows_saved = 0
+    start = lower
+    while True:
+        end = start + width
+        last = end >= upper
+        select, params = _create_window_sql(catalog_entry, columns, column,
+                                            tie_columns or (), start,
+                                            upper if last else end, last,
+                                            position, _server_format(config))
+        position = None
+        _execute(config, cursor, catalog_entry, select, params)
+        window_start = rows_saved
+        rows_saved, _ = _sync_rows(config, state, cursor, catalog_entry,
+                                   columns, converters, stream_version,
+                                   update_bookmarks, rows_saved, checkpoint)
+        output.write_state(state)
+        if last:
+            break
+        width = _next_window(width, rows_saved - window_start, window_rows,
+                             whole_days)
+        start = end
+    if rep_key.value is None:
+        rows_saved = _sync_null_keys(config, state, cursor, catalog_entry,
+                                     columns, converters, stream_version,
+                                     column, rows_saved)
+    return rows_saved
+
+
+def _sync_null_keys(config, state, cursor, catalog_entry, columns,
+                    converters, stream_version, column, rows_saved=0):
+    """Writes the rows whose replication key is NULL, which no window holds.
+    A first sync without windows reads them after every other row, since
+    DB2 sorts NULLs last. They leave the bookmark at the last key value."""
+    select = _select_sql(catalog_entry, columns,
+                         server_format=_server_format(config))
+    select += " WHERE {} IS NULL".format(_quote(column))
+    _execute(config, cursor, catalog_entry, select, ())
+
+    def update_bookmarks(state, record, row):
+        pass
+
+    rows_saved, _ = _sync_rows(config, state, cursor, catalog_entry, columns,
+                               converters, stream_version, update_bookmarks,
+                               rows_saved)
+    return rows_saved
+
+
+def _sync_keyset(config, state, cursor, catalog_entry, columns, converters,
+                 stream_version, key_columns, bookmark, bounds=None):
+    """Reads a table in pages ordered by its primary key. bookmark is the
+    dict the key of the last row written is stored in, as last_pk_fetched,
+    and read from to resume."""
+    key_values = None
+    last_pk_fetched = bookmark.get("last_pk_fetched")
+    if last_pk_fetched:
+        LOGGER.info("Resuming %s after primary key %s",
+                    catalog_entry.tap_stream_id, last_pk_fetched)
+        key_values = [_parse_bookmark_value(catalog_entry, c,
+                                            last_pk_fetched[c])
+                      for c in key_columns]
+    key_indexes = [columns.index(c) for c in key_columns]
+
+    def update_bookmarks(state, record, row):
+        bookmark["last_pk_fetched"] = {c: _bookmark_value(record[c])
+                                       for c in key_columns}
+
+    server_format = _server_format(config)
+
+    def next_page(last_row, page_size):
+        values = key_values
+        if last_row is not None:
+            values = [last_row[i] for i in key_indexes]
+            if server_format:
+                # Temporal keys were fetched as text.
+                values = [_parse_bookmark_value(catalog_entry, c, v)
+                          for c, v in zip(key_columns, values)]
+        return _create_keyset_sql(catalog_entry, columns, key_columns, values,
+                                  page_size, bounds, server_format)
+
+    return _sync_pages(config, state, cursor, catalog_entry, columns,
+                       converters, stream_version, update_bookmarks, next_page)
+
+
+def _sync_rrn_range(config, state, cursor, catalog_entry, columns,
+                    converters, stream_version, partition):
+    def update_bookmarks(state, record, row):
+        partition["last_rrn"] = row[-1]
+
+    def next_page(last_row, page_size):
+        if last_row is not None:
+            last_rrn = last_row[-1]
+        else:
+            last_rrn = partition.get("last_rrn") or partition["lower"] - 1
+        return _create_rrn_sql(catalog_entry, columns, last_rrn,
+                               partition["upper"], page_size,
+                               _server_format(config))
+
+    return _sync_pages(config, state, cursor, catalog_entry, columns,
+                       converters, stream_version, update_bookmarks, next_page)
+
+
+def _to_bookmark_value(catalog_entry, column, value):
+    """Converts a raw value of a column to the form it is emitted in, so
+    that it can be stored in the state and read back with
+    _parse_bookmark_value."""
+    convert = _CONVERTERS.get(_sql_data_type(catalog_entry, column))
+    if convert and value is not None:
+        value = convert(value)
+    return _bookmark_value(value)
+
+
+def _split_range(lower, upper, count):
+    """Returns up to count - 1 evenly spaced values between lower and
+    upper."""
+    step = (upper - lower) / count
+    if isinstance(lower, int):
+        step = (upper - lower) // count
+        if step == 0:
+            return []
+    return [lower + step * i for i in range(1, count)]
+
+
+def _key_boundaries(cursor, catalog_entry, column, count):
+    """Returns up to count - 1 values of column that split the table into
+    roughly equal ranges. Numeric keys are split evenly between their
+    minimum and maximum; other keys are split at the quantiles of a random
+    sample of their values."""
+    table = "{}.{}".format(_quote(catalog_entry.database),
+                           _quote(catalog_entry.table))
+    col_sql = _column_sql(catalog_entry, column)
+    data_type = _sql_data_type(catalog_entry, column)
+    if (data_type in schemas.BYTES_FOR_INTEGER_TYPE
+            or data_type in schemas.DECIMAL_TYPES):
+        cursor.execute("SELECT MIN({0}), MAX({0}) FROM {1}".format(col_sql,
+                                                                  table))
+        lower, upper = cursor.fetchone()
+        if lower is None:
+            return []
+        return _split_range(lower, upper, count)
+    cursor.execute("SELECT COUNT(*) FROM {}".format(table))
+    row_count = cursor.fetchone()[0]
+    if not row_count:
+        return []
+    fraction = min(1.0, PARTITION_SAMPLES_PER_PARTITION * count / row_count)
+    cursor.execute("SELECT {0} FROM {1} WHERE RAND() < ? ORDER BY 1".format(
+        col_sql, table), (fraction,))
+    sample = [r[0] for r in cursor.fetchall()]
+    boundaries = []
+    for i in range(1, count):
+        value = sample[len(sample) * i // count] if sample else None
+        if value is not None and value not in boundaries:
+            boundaries.append(value)
+    return boundaries
+
+
+def _plan_partitions(cursor, catalog_entry, key_columns, count):
+    """Splits a table into at most count partitions, by ranges of the first
+    primary key column if there is a primary key and by ranges of relative
+    record numbers otherwise. Returns a list of dicts suitable for storing
+    in the state."""
+    if key_columns:
+        column = key_columns[0]
+        boundaries = _key_boundaries(cursor, catalog_entry, column, count)
+        bounds = [None] + boundaries + [None]
+        return [{"lower": _to_bookmark_value(catalog_entry, column, start),
+                 "upper": _to_bookmark_value(catalog_entry, column, end),
+                 "done": False}
+                for start, end in zip(bounds, bounds[1:])]
+    cursor.execute("SELECT MIN(RRN(T)), MAX(RRN(T)) FROM {}.{} T".format(
+        _quote(catalog_entry.database), _quote(catalog_entry.table)))
+    lower, upper = cursor.fetchone()
+    if lower is None:
+        return [{"lower": 0, "upper": 0, "done": False}]
+    boundaries = _split_range(lower, upper + 1, count)
+    bounds = [lower] + boundaries + [upper + 1]
+    return [{"lower": start, "upper": end - 1, "done": False}
+            for start, end in zip(bounds, bounds[1:])]
+
+
+def _partition_bounds_sql(catalog_entry, column, partition):
+    col_sql = _column_sql(catalog_entry, column)
+    predicates = []
+    params = []
+    if partition["lower"] is not None:
+        predicates.append("{} >= ?".format(col_sql))
+        params.append(_parse_bookmark_value(catalog_entry, column,
+                                            partition["lower"]))
+    if partition["upper"] is not None:
+        predicates.append("{} < ?".format(col_sql))
+        params.append(_parse_bookmark_value(catalog_entry, column,
+                                            partition["upper"]))
+    if not predicates:
+        return None
+    return " AND ".join(predicates), params
+
+
+def _sync_partition(config, state, catalog_entry, columns, converters,
+                    stream_version, key_columns, partition):
+    with get_cursor(config) as cursor:
+        if key_columns:
+            bounds = _partition_bounds_sql(catalog_entry, key_columns[0],
+                                           partition)
+            rows_saved = _sync_keyset(config, state, cursor, catalog_entry,
+                                      columns, converters, stream_version,
+                                      key_columns, partition, bounds)
+        else:
+            rows_saved = _sync_rrn_range(config, state, cursor, catalog_entry,
+                                         columns, converters, stream_version,
+                                         partition)
+    export.close(catalog_entry)
+    with output.lock():
+        partition["done"] = True
+    output.write_state(state)
+    return rows_saved
+
+
+def _partition_count(config, catalog_entry):
+    mdata = metadata.to_map(catalog_entry.metadata).get((), {})
+    return int(mdata.get("table-partitions",
+                         config.get("table_partitions", 1)))
+
+
+def _sync_partitioned(config, state, catalog_entry, columns, converters,
+                      stream_version, key_columns, count):
+    """Syncs a full table as several partitions read concurrently on
+    separate connections. The partitions are stored in the state along with
+    the position reached in each, so an interrupted sync resumes every
+    partition under the same stream version."""
+    tap_stream_id = catalog_entry.tap_stream_id
+    partitions = _get_bk(state, tap_stream_id, "partitions")
+    if partitions:
+        LOGGER.info("Resuming %d partitions of %s", len(partitions),
+                    tap_stream_id)
+    else:
+        with get_cursor(config) as cursor:
+            partitions = _plan_partitions(cursor, catalog_entry, key_columns,
+                                          count)
+        LOGGER.info("Split %s into %d partitions: %s", tap_stream_id,
+                    len(partitions), partitions)
+        state = _set_bookmark(state, tap_stream_id, "partitions", partitions)
+        output.write_state(state)
+    pending = [p for p in partitions if not p["done"]]
+    results = _run_concurrently(
+        [(_sync_partition, (config, state, catalog_entry, columns, converters,
+                            stream_version, key_columns, p))
+         for p in pending],
+        max(len(pending), 1))
+    return sum(results)
+
+
+def _sync_full_table(config, state, catalog_entry, columns, converters,
+                     stream_version, key_columns):
+    tap_stream_id = catalog_entry.tap_stream_id
+    if catalog_entry.is_view:
+        # view-key-properties are declared by the user rather than enforced
+        # by DB2, so they may not be unique, and paging or splitting on them
+        # could skip rows that share a key. Views are read in one query and
+        # have no RRN to split on either.
+        key_columns = []
+    partitions = _partition_count(config, catalog_entry)
+    if partitions > 1 and not catalog_entry.is_view:
+        return _sync_partitioned(config, state, catalog_entry, columns,
+                                 converters, stream_version, key_columns,
+                                 partitions)
+    with get_cursor(config) as cursor:
+        if key_columns:
+            bookmark = state["bookmarks"][tap_stream_id]
+            return _sync_keyset(config, state, cursor, catalog_entry, columns,
+                                converters, stream_version, key_columns,
+                                bookmark)
+        return _sync_incremental(config, state, cursor, catalog_entry,
+                                 columns, converters, stream_version, None)
+
+
+def _sync_journal(config, state, cursor, catalog_entry, columns,
+                  stream_version, table_journal, bookmark):
+    """Writes the changes recorded in the journal after the sequence number
+    in bookmark. Deleted rows are written with the time they were deleted
+    in _sdc_deleted_at."""
+    # Values decoded from the journal are never formatted by the server.
+    converters = _compile_converters(catalog_entry, columns)
+    layout = journal.record_layout(cursor, catalog_entry)
+    journal.check_layout(layout, columns)
+    timezone = journal.current_timezone(cursor)
+    select, params = journal.entries_sql(table_journal,
+                                         bookmark["journal_sequence"] + 1)
+    _execute(config, cursor, catalog_entry, select, params)
+
+    def update_bookmarks(state, record, row):
+        bookmark["journal_sequence"] = int(row[-1])
+
+    rows_saved, _ = _sync_rows(
+        config, state,
+        journal.JournalCursor(cursor, layout, columns, timezone),
+        catalog_entry, columns + [SDC_DELETED_AT],
+        converters + [(len(columns), _format_datetime)],
+        stream_version, update_bookmarks)
+    return rows_saved
+
+
+def _sync_log_based(config, state, catalog_entry, columns, converters,
+                    stream_version, key_columns):
+    """Syncs a stream from the table's journal. The first time, the current
+    journal position is stored and the whole table is synced, after which
+    only the changes made since that position are read."""
+    tap_stream_id = catalog_entry.tap_stream_id
+    bookmark = state["bookmarks"][tap_stream_id]
+    with get_cursor(config) as cursor:
+        table_journal = journal.find_journal(cursor, catalog_entry)
+        if bookmark.get("journal_sequence") is None:
+            sequence = journal.current_sequence(cursor, table_journal)
+            with output.lock():
+                bookmark["journal_sequence"] = sequence
+            output.write_state(state)
+    rows_saved = 0
+    if not bookmark.get("initial_full_table_complete"):
+        LOGGER.info("Running an initial full table sync of %s from journal "
+                    "sequence %s", tap_stream_id, bookmark["journal_sequence"])
+        rows_saved = _sync_full_table(config, state, catalog_entry, columns,
+                                      converters, stream_version, key_columns)
+        export.close(catalog_entry)
+        _activate_version(catalog_entry, stream_version)
+        with output.lock():
+            bookmark["initial_full_table_complete"] = True
+            bookmark.pop("last_pk_fetched", None)
+            bookmark.pop("partitions", None)
+        output.write_state(state)
+    LOGGER.info("Reading the journal %s/%s for %s from sequence %s",
+                table_journal.library, table_journal.name, tap_stream_id,
+                bookmark["journal_sequence"] + 1)
+    with get_cursor(config) as cursor:
+        rows_saved += _sync_journal(config, state, cursor, catalog_entry,
+                                    columns, stream_version, table_journal,
+                                    bookmark)
+    return rows_saved
+
+
 def _sync_table(config, state, catalog_entry):
     columns = list(catalog_entry.schema.properties)
     if not columns:
@@ -139,52 +1224,135 @@ def _sync_table(config, state, catalog_entry):
             catalog_entry.table)
         return
     tap_stream_id = catalog_entry.tap_stream_id
+    stream_timings = timings.start(catalog_entry)
+    config = _stream_config(config, catalog_entry)
+    if config.get("fetch_block_size_kb"):
+        LOGGER.info("Fetching %s in blocks of %s KB", tap_stream_id,
+                    config["fetch_block_size_kb"])
     rep_key = _get_replication_key(state, catalog_entry)
     stream_version = _get_stream_version(tap_stream_id, state)
-    state = _set_bk(state, tap_stream_id, "version", stream_version)
-    _maybe_activate_before_sync(state, catalog_entry, rep_key, stream_version)
-    select, params = _create_sql(catalog_entry, columns, rep_key)
-    with get_cursor(config) as cursor:
-        LOGGER.info("Running %s PARAMS (%s)", select, params)
-        cursor.execute(select, params)
-        rows_saved = 0
-        for row in cursor:
-            rows_saved += 1
-            record_message = _row_to_record(catalog_entry, stream_version, row,
-                                            columns)
-            _emit(record_message)
-            if rep_key:
-                state = _set_bk(state, tap_stream_id, "replication_key_value",
-                                record_message.record[rep_key.column])
-            if rows_saved % 1000 == 0:
-                _emit(singer.StateMessage(value=state))
-        _write_metrics(catalog_entry, rows_saved)
-    state = _maybe_activate_after_sync(state, catalog_entry, rep_key, stream_version)
-    _emit(singer.StateMessage(value=state))
+    state = _set_bookmark(state, tap_stream_id, "version", stream_version)
+    log_based = _replication_method(catalog_entry) == "LOG_BASED"
+    if log_based:
+        reads_whole_table = not _get_bk(state, tap_stream_id,
+                                        "initial_full_table_complete")
+    else:
+        reads_whole_table = not (rep_key and rep_key.value is not None)
+    progress.start_stream(tap_stream_id, reads_whole_table)
+    if not log_based:
+        _maybe_activate_before_sync(state, catalog_entry, rep_key,
+                                    stream_version)
+    key_columns = _key_properties(catalog_entry)
+    if not set(key_columns).issubset(columns):
+        key_columns = []
+    converters = _compile_converters(catalog_entry, columns,
+                                     _server_format(config))
+    if log_based:
+        # The stream version is kept for as long as changes are read from
+        # the journal, so there is nothing to activate after each sync.
+        rows_saved = _sync_log_based(config, state, catalog_entry, columns,
+                                     converters, stream_version, key_columns)
+    elif rep_key:
+        if catalog_entry.is_view:
+            # view-key-properties may not be unique, so they can't break
+            # ties between rows with the same replication key value. Views
+            # resume inclusively from the replication key instead.
+            key_columns = []
+        window_rows = int(config.get("incremental_window_rows", 0))
+        with get_cursor(config) as cursor:
+            if window_rows:
+                rows_saved = _sync_incremental_windows(
+                    config, state, cursor, catalog_entry, columns,
+                    converters, stream_version, rep_key, window_rows,
+                    key_columns)
+            else:
+                rows_saved = _sync_incremental(
+                    config, state, cursor, catalog_entry, columns,
+                    converters, stream_version, rep_key, key_columns)
+    else:
+        rows_saved = _sync_full_table(config, state, catalog_entry, columns,
+                                      converters, stream_version, key_columns)
+    export.close(catalog_entry)
+    _write_metrics(catalog_entry, rows_saved)
+    if not log_based:
+        state = _maybe_activate_after_sync(state, catalog_entry, rep_key,
+                                           stream_version)
+    output.write_state(state)
+    progress.report(tap_stream_id)
+    stream_timings.write_metrics()
+    timings.write_metrics_file(config)
+    timings.write_profile(config, stream_timings)
 
 
-def sync(config, state, catalog):
+def _run_concurrently(calls, max_workers):
+    """Runs each (function, args) pair in calls on a thread pool and returns
+    their results in order. If any of them fails, the calls that haven't
+    started yet are cancelled and the first error is raised once the
+    running ones finish."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fn, *args) for fn, args in calls]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+
+
+def _sync_stream(config, state, catalog_entry):
+    catalog_metadata = metadata.to_map(catalog_entry.metadata)
+    replication_key = catalog_metadata.get((), {}).get('replication-key')
+    key_properties = _key_properties(catalog_entry)
+
+    schema = catalog_entry.schema.to_dict()
+    if _replication_method(catalog_entry) == "LOG_BASED":
+        schema["properties"][SDC_DELETED_AT] = {"type": ["null", "string"],
+                                                "format": "date-time"}
+    _emit(singer.SchemaMessage(
+        stream=catalog_entry.stream,
+        schema=schema,
+        key_properties=key_properties,
+        bookmark_properties=replication_key
+      ))
+    with metrics.job_timer("sync_table") as timer:
+        timer.tags["schema"] = catalog_entry.database
+        timer.tags["table"] = catalog_entry.table
+        _sync_table(config, state, catalog_entry)
+
+
+def _sync_serial(config, state, catalog):
+    # Resuming from currently_syncing skips the streams before it in catalog
+    # order, which are only the ones already synced if the catalog order is
+    # kept. Otherwise each stream resumes from its own bookmarks.
+    in_catalog_order = config.get("stream_order", "catalog") == "catalog"
     for catalog_entry in catalog.streams:
-        catalog_metadata = metadata.to_map(catalog_entry.metadata)
-        replication_key = catalog_metadata.get((), {}).get('replication-key')
+        state = singer.set_currently_syncing(
+            state, catalog_entry.tap_stream_id if in_catalog_order else None)
+        output.write_state(state)
+        _sync_stream(config, state, catalog_entry)
 
-        state = singer.set_currently_syncing(state, catalog_entry.tap_stream_id)
-        _emit(singer.StateMessage(value=state))
-        if catalog_entry.is_view:
-            key_properties = metadata.to_map(catalog_entry.metadata).get((), {}).get('view-key-properties', [])
+
+def _sync_parallel(config, state, catalog, max_workers):
+    # Streams finish in an arbitrary order, so currently_syncing can't be
+    # used to resume; each stream resumes from its own bookmarks instead.
+    state = singer.set_currently_syncing(state, None)
+    LOGGER.info("Syncing %d streams with up to %d in parallel",
+                len(catalog.streams), max_workers)
+    _run_concurrently([(_sync_stream, (config, state, catalog_entry))
+                       for catalog_entry in catalog.streams],
+                      max_workers)
+
+
+def sync(config, state, catalog):
+    max_parallel_streams = int(config.get("max_parallel_streams", 1))
+    catalog = Catalog(progress.start_run(config, catalog.streams))
+    try:
+        if max_parallel_streams > 1:
+            _sync_parallel(config, state, catalog, max_parallel_streams)
         else:
-            key_properties = metadata.to_map(catalog_entry.metadata).get((), {}).get('table-key-properties', [])
-
-
-        _emit(singer.SchemaMessage(
-            stream=catalog_entry.stream,
-            schema=catalog_entry.schema.to_dict(),
-            key_properties=key_properties,
-            bookmark_properties=replication_key
-          ))
-        with metrics.job_timer("sync_table") as timer:
-            timer.tags["schema"] = catalog_entry.database
-            timer.tags["table"] = catalog_entry.table
-            _sync_table(config, state, catalog_entry)
+            _sync_serial(config, state, catalog)
+    finally:
+        encoder.shutdown()
     state = singer.set_currently_syncing(state, None)
-    _emit(singer.StateMessage(value=state))
+    output.write_state(state)
@@ -0,0 +1,212 @@
+"""Measures where the time spent syncing each stream goes.
+
+The time is split into stages: running the query (execute), fetching rows
+from the driver (fetch), converting them to records (convert), encoding
+records as JSON (encode) and handing the encoded messages to the output,
+which includes time blocked on stdout when the target applies back-pressure
+(write). Time to first row is measured from the start of the stream."""
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from time import perf_counter
+import singer
+import singer.metrics as metrics
+
+LOGGER = singer.get_logger()
+
+STAGES = ("execute", "fetch", "convert", "encode", "write")
+DEFAULT_PROFILE_INTERVAL_MS = 10
+
+
+class StreamTimings(object):
+    def __init__(self, catalog_entry):
+        self.tap_stream_id = catalog_entry.tap_stream_id
+        self.tags = {"schema": catalog_entry.database,
+                     "table": catalog_entry.table}
+        self.seconds = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.rows = 0
+        self.started = perf_counter()
+        self.time_to_first_row = None
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def add_rows(self, rows, convert, encode, write):
+        """Adds the times measured over a batch of rows."""
+        with self._lock:
+            self.rows += rows
+            self.seconds["convert"] += convert
+            self.seconds["encode"] += encode
+            self.seconds["write"] += write
+
+    def first_row(self):
+        with self._lock:
+            if self.time_to_first_row is None:
+                self.time_to_first_row = perf_counter() - self.started
+
+    def write_metrics(self):
+        """Logs the stage times as Singer METRIC messages."""
+        for stage, seconds in self.seconds.items():
+            tags = dict(self.tags, stage=stage)
+            metrics.log(LOGGER, metrics.Point("timer", "sync_stage_duration",
+                                              seconds, tags))
+        if self.time_to_first_row is not None:
+            metrics.log(LOGGER, metrics.Point("timer", "time_to_first_row",
+                                              self.time_to_first_row,
+                                              self.tags))
+
+
+_TIMINGS = OrderedDict()
+_TIMINGS_LOCK = threading.Lock()
+
+
+def start(catalog_entry):
+    """Starts timing a stream, replacing any earlier timings of it."""
+    timings = StreamTimings(catalog_entry)
+    with _TIMINGS_LOCK:
+        _TIMINGS[catalog_entry.tap_stream_id] = timings
+    return timings
+
+
+def reset():
+    """Forgets the timings of every stream, so that a long-lived process
+    only reports the streams of its current run."""
+    with _TIMINGS_LOCK:
+        _TIMINGS.clear()
+
+
+def get(tap_stream_id):
+    """Returns the timings of a stream, or None if it isn't being timed."""
+    return _TIMINGS.get(tap_stream_id)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _prometheus_text():
+    lines = [
+        "# HELP tap_db2_stage_seconds_total Seconds spent in each stage of "
+        "syncing a stream.",
+        "# TYPE tap_db2_stage_seconds_total counter",
+    ]
+    with _TIMINGS_LOCK:
+        all_timings = list(_TIMINGS.values())
+    for timings in all_timings:
+        for stage, seconds in timings.seconds.items():
+            lines.append('tap_db2_stage_seconds_total{{schema="{}",table="{}",'
+                         'stage="{}"}} {:.6f}'.format(
+                             _label(timings.tags["schema"]),
+                             _label(timings.tags["table"]), stage, seconds))
+    lines += [
+        "# HELP tap_db2_rows_total Rows synced from a stream.",
+        "# TYPE tap_db2_rows_total counter",
+    ]
+    for timings in all_timings:
+        lines.append('tap_db2_rows_total{{schema="{}",table="{}"}} {}'.format(
+            _label(timings.tags["schema"]), _label(timings.tags["table"]),
+            timings.rows))
+    lines += [
+        "# HELP tap_db2_time_to_first_row_seconds Seconds from the start of "
+        "a stream to its first row.",
+        "# TYPE tap_db2_time_to_first_row_seconds gauge",
+    ]
+    for timings in all_timings:
+        if timings.time_to_first_row is not None:
+            lines.append('tap_db2_time_to_first_row_seconds{{schema="{}",'
+                         'table="{}"}} {:.6f}'.format(
+                             _label(timings.tags["schema"]),
+                             _label(timings.tags["table"]),
+                             timings.time_to_first_row))
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(config):
+    """Writes the timings of every stream so far to metrics_file, in the
+    Prometheus text format, if it is configured. The file is replaced in
+    one step so a scraper never reads a partial file. Streams synced in
+    parallel each write their own temporary file."""
+    path = config.get("metrics_file")
+    if not path:
+        return
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path) or ".",
+                                     prefix=os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as f:
+        f.write(_prometheus_text())
+    # Temporary files are only readable by their owner.
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+
+
+class Sampler(object):
+    """Samples the stack of the thread it was created on at a fixed interval
+    while it is in use as a context manager, counting each distinct stack
+    into timings.stacks."""
+    def __init__(self, timings, interval_ms=DEFAULT_PROFILE_INTERVAL_MS):
+        self.timings = timings
+        self.interval = interval_ms / 1000.0
+        self.thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stack(self):
+        frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{}:{}".format(
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            stack = self._stack()
+            if stack:
+                with self.timings._lock:  # pylint: disable=protected-access
+                    self.timings.stacks[stack] += 1
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+
+
+class _NoSampler(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def sampler(config, timings):
+    """Returns a context manager to wrap the row loop in, which samples it
+    if profile_dir is configured and does nothing otherwise."""
+    if not config.get("profile_dir"):
+        return _NoSampler()
+    return Sampler(timings, float(config.get("profile_interval_ms",
+                                             DEFAULT_PROFILE_INTERVAL_MS)))
+
+
+def write_profile(config, timings):
+    """Writes the sampled stacks of a stream to profile_dir in the collapsed
+    format flamegraph.pl and speedscope read."""
+    profile_dir = config.get("profile_dir")
+    if not profile_dir or not timings.stacks:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, "{}.folded".format(timings.tap_stream_id))
+    with open(path, "w") as f:
+        for stack, count in timings.stacks.most_common():
+            f.write("{} {}\n".format(stack, count))
+    LOGGER.info("Wrote profile of %s to %s", timings.tap_stream_id, path)
@@ -0,0 +1,68 @@
+import mock
+import pyodbc
+import tap_db2.common as common
+
+CONFIG = {"host": "a_host", "user": "a_user", "password": "a_password"}
+
+
+@mock.patch("tap_db2.common.connection")
+def test_pool_reuses_returned_connections(connection_mock):
+    connection_mock.side_effect = lambda config: mock.MagicMock()
+    pool = common.ConnectionPool(CONFIG)
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert connection_mock.call_count == 1
+    conn.rollback.assert_called_once_with()
+
+
+@mock.patch("tap_db2.common.connection")
+def test_pool_evicts_broken_connections(connection_mock):
+    connection_mock.side_effect = lambda config: mock.MagicMock()
+    pool = common.ConnectionPool(CONFIG)
+    conn = pool.acquire()
+    pool.release(conn, broken=True)
+    conn.close.assert_called_once_with()
+    assert pool.acquire() is not conn
+
+
+@mock.patch("tap_db2.common.time_")
+@mock.patch("tap_db2.common.connection")
+def test_pool_validates_idle_connections(connection_mock, time_mock):
+    connection_mock.side_effect = lambda config: mock.MagicMock()
+    time_mock.return_value = 0
+    pool = common.ConnectionPool(CONFIG)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.cursor.return_value.execute.side_effect = pyodbc.Error("gone")
+    time_mock.return_value = common.VALIDATE_AFTER_IDLE_SECONDS + 1
+    assert pool.acquire() is not conn
+    conn.close.assert_called_once_with()
+
+
+@mock.patch("tap_db2.common.connection")
+def test_get_cursor_draws_from_pool(connection_mock):
+    connection_mock.side_effect = lambda config: mock.MagicMock()
+    common.close_pools()
+    with common.get_cursor(CONFIG):
+        pass
+    with common.get_cursor(CONFIG):
+        pass
+    assert connection_mock.call_count == 1
+    try:
+        with common.get_cursor(CONFIG):
+            raise pyodbc.OperationalError("connection lost")
+    except pyodbc.OperationalError:
+        pass
+    with common.get_cursor(CONFIG):
+        pass
+    assert connection_mock.call_count == 2
+    common.close_pools()
+
+
+@mock.patch("tap_db2.common.pyodbc.connect", create=True)
+def test_fetch_block_size_is_a_connection_option(connect_mock):
+    common.connection(dict(CONFIG, fetch_block_size_kb=512))
+    assert connect_mock.call_args[1]["blocksize"] == 512
+    assert (common._pool_key(CONFIG)
+            != common._pool_key(dict(CONFIG, fetch_block_size_kb=512)))
@@ -1,3 +1,7 @@
+import datetime
+import io
+import json
+import threading
 import mock
 import tap_db2.discovery as d
 
@@ -16,15 +20,15 @@ def test_basic_discovery(pks_mock, columns_mock, tables_mock):
         ("a_schema", "a_table", "T"),
     ]
     columns_mock.return_value = [
-        ("a_schema", "a_table", "a_column", "FLOAT", None, None, None),
-        ("a_schema", "a_table", "b_column", "FLOAT", None, None, None),
-        ("a_schema", "a_table", "c_column", "FLOAT", None, None, None),
+        ("a_schema", "a_table", "a_column", "FLOAT", None, None, None, None),
+        ("a_schema", "a_table", "b_column", "FLOAT", None, None, None, None),
+        ("a_schema", "a_table", "c_column", "FLOAT", None, None, None, None),
     ]
     pks_mock.return_value = [
         ("a_schema", "a_table", "a_column", 2),
         ("a_schema", "a_table", "b_column", 1),
     ]
-    ctx = mock.MagicMock()
+    ctx = {}
     catalog = d.discover(ctx).to_dict()
     streams = catalog["streams"]
     float_schema = {"inclusion": "available", "type": ["null", "number"]}
@@ -35,9 +39,6 @@ def test_basic_discovery(pks_mock, columns_mock, tables_mock):
         "type": "object",
     }
     streams[0]["metadata"].sort(key=lambda x: x["breadcrumb"])
-    import pprint
-    import sys
-    pprint.pprint(streams[0])
     assert streams[0] == {
         "database_name": "a_schema",
         "table_name": "a_table",
@@ -45,9 +46,11 @@ def test_basic_discovery(pks_mock, columns_mock, tables_mock):
         "schema": expected_schema,
         "stream": "a_table",
         "is_view": False,
-        "key_properties": ["b_column", "a_column"],
         "metadata": [{"breadcrumb": (),
-                      "metadata": {"selected-by-default": False}},
+                      "metadata": {"selected-by-default": False,
+                                   "table-key-properties": ["b_column",
+                                                            "a_column"],
+                                   "valid-replication-keys": []}},
                      {"breadcrumb": ("properties", "a_column"),
                       "metadata": {"selected-by-default": True,
                                    "sql-datatype": "float"}},
@@ -60,7 +63,6 @@ def test_basic_discovery(pks_mock, columns_mock, tables_mock):
     }
 
 
-
 @mock.patch("tap_db2.discovery._query_tables")
 @mock.patch("tap_db2.discovery._query_columns")
 @mock.patch("tap_db2.discovery._query_primary_keys")
@@ -69,9 +71,9 @@ def test_decimal_types(pks_mock, columns_mock, tables_mock):
         ("a_schema", "a_table", "T"),
     ]
     columns_mock.return_value = [
-        ("a_schema", "a_table", "a_column", "decimal", None, 10, 4),
+        ("a_schema", "a_table", "a_column", "decimal", None, 10, 4, None),
     ]
-    ctx = mock.MagicMock()
+    ctx = {}
     catalog = d.discover(ctx).to_dict()
     schema = catalog["streams"][0]["schema"]["properties"]["a_column"]
     # precision = number of digits
@@ -87,3 +89,131 @@ def test_decimal_types(pks_mock, columns_mock, tables_mock):
                       "minimum": -expected_limit,
                       "maximum": expected_limit,
                       "multipleOf": 0.0001}
+
+
+@mock.patch("tap_db2.discovery._query_tables")
+@mock.patch("tap_db2.discovery._query_columns")
+@mock.patch("tap_db2.discovery._query_primary_keys")
+def test_catalog_queries_run_concurrently(pks_mock, columns_mock, tables_mock):
+    started = {name: threading.Event() for name in ("columns", "pks")}
+
+    def query_tables(config):
+        # Only returns once the other two queries have been started.
+        assert all(e.wait(5) for e in started.values())
+        return [("a_schema", "a_table", "T")]
+
+    def query(name, rows):
+        def _query(config, table_ids=None):
+            started[name].set()
+            return rows
+        return _query
+
+    tables_mock.side_effect = query_tables
+    columns_mock.side_effect = query("columns", [
+        ("a_schema", "a_table", "a_column", "integer", None, None, None, None),
+        ("a_schema", "other", "a_column", "integer", None, None, None, None),
+    ])
+    pks_mock.side_effect = query("pks", [
+        ("a_schema", "a_table", "a_column", 1),
+        ("a_schema", "other", "a_column", 1),
+    ])
+    streams = d.discover({}).to_dict()["streams"]
+    assert [s["tap_stream_id"] for s in streams] == ["a_schema-a_table"]
+    assert list(streams[0]["schema"]["properties"]) == ["a_column"]
+    assert streams[0]["metadata"][0]["metadata"]["table-key-properties"] == [
+        "a_column"]
+
+
+@mock.patch("tap_db2.discovery._query_table_timestamps")
+@mock.patch("tap_db2.discovery._query_columns")
+@mock.patch("tap_db2.discovery._query_primary_keys")
+def test_cached_discovery_only_requeries_changed_tables(
+        pks_mock, columns_mock, tables_mock, tmpdir):
+    config = {"host": "a_host", "discovery_cache_dir": str(tmpdir)}
+    old = datetime.datetime(2020, 1, 1)
+    new = datetime.datetime(2020, 2, 1)
+    columns = {
+        "a_table": ("a_schema", "a_table", "a_column", "integer",
+                    None, None, None, None),
+        "b_table": ("a_schema", "b_table", "b_column", "integer",
+                    None, None, None, None),
+    }
+    tables_mock.return_value = [("a_schema", "a_table", "T", old),
+                                ("a_schema", "b_table", "T", old)]
+    columns_mock.return_value = list(columns.values())
+    pks_mock.return_value = []
+    first = d.discover(config).to_dict()
+    columns_mock.assert_called_once_with(config, [("a_schema", "a_table"),
+                                                  ("a_schema", "b_table")])
+
+    columns_mock.reset_mock()
+    tables_mock.return_value = [("a_schema", "a_table", "T", old),
+                                ("a_schema", "b_table", "T", new),
+                                ("a_schema", "c_table", "T", new)]
+    columns_mock.return_value = [columns["b_table"]]
+    second = d.discover(config).to_dict()
+    columns_mock.assert_called_once_with(config, [("a_schema", "b_table"),
+                                                  ("a_schema", "c_table")])
+    assert json.loads(json.dumps(second["streams"][:2])) == \
+        json.loads(json.dumps(first["streams"]))
+    assert second["streams"][2]["tap_stream_id"] == "a_schema-c_table"
+
+    columns_mock.reset_mock()
+    pks_mock.reset_mock()
+    third = d.discover(config).to_dict()
+    columns_mock.assert_not_called()
+    pks_mock.assert_not_called()
+    assert json.loads(json.dumps(third)) == json.loads(json.dumps(second))
+
+
+def test_filters_are_pushed_into_every_catalog_query():
+    config = {"filter_schemas": "s1, s2", "filter_tables": "ORD*,INV?,!*_BAK"}
+    cursor = mock.MagicMock()
+    cursor.__iter__.return_value = iter([])
+    get_cursor = mock.MagicMock()
+    get_cursor.return_value.__enter__.return_value = cursor
+    with mock.patch("tap_db2.discovery.get_cursor", get_cursor):
+        for query in (d._query_tables, d._query_columns,
+                      d._query_primary_keys):
+            list(query(config))
+    assert cursor.execute.call_count == 3
+    for call in cursor.execute.call_args_list:
+        sql, binds = call[0]
+        assert "table_schema IN (?,?)" in sql
+        assert "table_name LIKE ?" in sql
+        assert "NOT" in sql
+        assert binds[-5:] == ["s1", "s2", "ORD%", "INV_", "%\\_BAK"]
+
+
+@mock.patch("tap_db2.discovery._query_catalog")
+@mock.patch("tap_db2.discovery._query_tables")
+@mock.patch("tap_db2.discovery._query_columns")
+@mock.patch("tap_db2.discovery._query_primary_keys")
+def test_streaming_discovery_matches_discovery(pks_mock, columns_mock,
+                                               tables_mock, catalog_mock):
+    tables_mock.return_value = [("a_schema", "a_table", "T"),
+                                ("a_schema", "b_table", "V"),
+                                ("a_schema", "c_table", "T")]
+    columns_mock.return_value = [
+        ("a_schema", "a_table", "id", "integer", None, None, None, None),
+        ("a_schema", "a_table", "id2", "integer", None, None, None, None),
+        ("a_schema", "a_table", "name", "varchar", 10, None, None, 37),
+        ("a_schema", "b_table", "amount", "decimal", None, 10, 2, None),
+    ]
+    pks_mock.return_value = [("a_schema", "a_table", "id2", 1),
+                             ("a_schema", "a_table", "id", 2)]
+    catalog_mock.return_value = [
+        ("a_schema", "a_table", "T", "id", "integer", None, None, None, None, 2),
+        ("a_schema", "a_table", "T", "id2", "integer", None, None, None, None, 1),
+        ("a_schema", "a_table", "T", "name", "varchar", 10, None, None, 37, None),
+        ("a_schema", "b_table", "V", "amount", "decimal", None, 10, 2, None, None),
+        # A table without readable columns.
+        ("a_schema", "c_table", "T", None, None, None, None, None, None, None),
+    ]
+    out = io.StringIO()
+    d.dump_streaming({}, out)
+    expected = json.loads(json.dumps(d.discover({}).to_dict()))
+    assert json.loads(out.getvalue()) == expected
+    assert expected["streams"][0]["metadata"][0]["metadata"][
+        "table-key-properties"] == ["id2", "id"]
+    assert expected["streams"][2]["tap_stream_id"] == "a_schema-c_table"
@@ -0,0 +1,90 @@
+import decimal
+import gzip
+import io
+import json
+import mock
+import pytest
+import singer
+import tap_db2.output as output
+import tap_db2.compression as compression
+
+
+def _write_all(writer):
+    writer.write_message(singer.SchemaMessage(stream="a_table",
+                                              schema={"type": "object"},
+                                              key_properties=[]))
+    writer.write_record("a_table", 123, {"id": 1, "d": decimal.Decimal("1.50"),
+                                         "s": "café \"x\""})
+    writer.write_record("a_table", None, {"id": 2, "d": None, "s": ""})
+    writer.write_state({"bookmarks": {}})
+
+
+def test_buffered_writer_matches_singer_format():
+    expected = io.StringIO()
+    _write_all(output.MessageWriter(expected))
+    actual = io.StringIO()
+    with mock.patch("tap_db2.output.rapidjson", None):
+        _write_all(output.BufferedMessageWriter(actual))
+    assert actual.getvalue() == expected.getvalue()
+
+
+
+def test_rapidjson_writer_matches_singer_values():
+    if output.rapidjson is None:
+        pytest.skip("python-rapidjson is not installed")
+    expected = io.StringIO()
+    actual = io.StringIO()
+    record = {"id": 1, "d": decimal.Decimal("1.50"), "s": "café",
+              "nan": float("nan"), "inf": float("inf"),
+              "ninf": float("-inf"), "n": None}
+    output.MessageWriter(expected).write_record("a_table", 1, record)
+    writer = output.BufferedMessageWriter(actual)
+    writer.write_record("a_table", 1, record)
+    writer.flush()
+    # rapidjson writes compact JSON, so compare the parsed messages.
+    def parse(text):
+        return json.loads(text, parse_float=decimal.Decimal)
+    assert repr(parse(actual.getvalue())) == repr(parse(expected.getvalue()))
+
+def test_buffered_writer_holds_records_until_state():
+    out = io.StringIO()
+    writer = output.BufferedMessageWriter(out)
+    writer.write_record("a_table", 1, {"d": decimal.Decimal("10.25")})
+    assert out.getvalue() == ""
+    writer.write_state({"bookmarks": {}})
+    lines = [json.loads(l, parse_float=decimal.Decimal)
+             for l in out.getvalue().splitlines()]
+    assert lines[0] == {"type": "RECORD", "stream": "a_table", "version": 1,
+                        "record": {"d": decimal.Decimal("10.25")}}
+    assert lines[1]["type"] == "STATE"
+
+
+def test_gzip_output_matches_plain_output(tmpdir):
+    expected = io.StringIO()
+    _write_all(output.MessageWriter(expected))
+    path = str(tmpdir.join("out.gz"))
+    output.configure({"output_compression": "gzip",
+                      "output_compression_level": 9, "output_file": path})
+    try:
+        _write_all(output.get_writer())
+    finally:
+        output.close()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert f.read() == expected.getvalue()
+
+
+def test_compressed_output_flushes_at_most_every_interval():
+    raw = io.BytesIO()
+    with mock.patch("tap_db2.compression.time.monotonic",
+                    side_effect=[0.0, 0.5, 2.0]):
+        out = compression.CompressedOutput(raw, "gzip")
+        out.write("a line\n")
+        out.flush()
+        out.write("another line\n")
+        out.flush()
+    out.close()
+    assert gzip.decompress(raw.getvalue()) == b"a line\nanother line\n"
+    # Only the second flush was due, and a sync flush ends with an empty
+    # stored block.
+    assert raw.getvalue().count(b"\x00\x00\xff\xff") == 1
+    assert out.bytes_in == len(b"a line\nanother line\n")
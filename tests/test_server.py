@@ -0,0 +1,90 @@
+import contextlib
+import json
+import os
+import socket
+import threading
+import mock
+from singer import metadata
+from singer.catalog import Catalog, CatalogEntry
+from singer.schema import Schema
+import tap_db2.server as server
+import tap_db2.timings as timings
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.rows = iter([])
+        self.arraysize = 1
+
+    def execute(self, sql, params=()):
+        rows = [(i,) for i in range(5)]
+        if params:
+            rows = [r for r in rows if r[0] > params[0]]
+        self.rows = iter(rows)
+
+    def fetchmany(self, size=None):
+        return [row for _, row in zip(range(size or self.arraysize),
+                                      self.rows)]
+
+
+@contextlib.contextmanager
+def _get_cursor(config):
+    yield FakeCursor()
+
+
+def _catalog():
+    mdata = {(): {"selected": True, "table-key-properties": ["id"],
+                  "replication-key": "id"},
+             ("properties", "id"): {"sql-datatype": "integer"}}
+    return Catalog([CatalogEntry(
+        tap_stream_id="a_schema-t", stream="t", database="a_schema",
+        table="t",
+        schema=Schema(type="object", selected=True, properties={
+            "id": Schema(type=["null", "integer"], inclusion="automatic")}),
+        metadata=metadata.to_list(mdata))])
+
+
+def _records(lines):
+    return [m["record"]["id"] for m in map(json.loads, lines)
+            if m["type"] == "RECORD"]
+
+
+@mock.patch("tap_db2.sync.get_cursor", _get_cursor)
+def test_spooled_jobs_write_their_output(tmpdir):
+    spool = str(tmpdir)
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "id",
+                                          "replication_key_value": 2}}}
+    tmpdir.join("1.json").write(json.dumps({"state": state}))
+    tmpdir.join("2.json").write(json.dumps({"streams": ["a_schema-x"]}))
+    timings._TIMINGS["a_schema-earlier"] = None
+    server.process_spool({}, _catalog(), spool)
+    # Each job only keeps the timings of its own streams.
+    assert list(timings._TIMINGS) == ["a_schema-t"]
+    assert sorted(os.listdir(spool)) == ["1.done", "1.out", "2.failed"]
+    with open(os.path.join(spool, "1.out")) as f:
+        assert _records(f) == [3, 4]
+
+
+@mock.patch("tap_db2.sync.get_cursor", _get_cursor)
+def test_socket_jobs_stream_output_back(tmpdir):
+    path = str(tmpdir.join("tap.sock"))
+    config = {"server_socket": path, "server_poll_seconds": 0.05}
+    stopped = threading.Event()
+    thread = threading.Thread(target=server.serve,
+                              args=(config, _catalog(), stopped))
+    thread.start()
+    try:
+        for _ in range(2):
+            while not os.path.exists(path):
+                stopped.wait(0.01)
+            assert os.stat(path).st_mode & 0o077 == 0
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            with client, client.makefile("rw", encoding="utf-8") as f:
+                f.write(json.dumps({"state": {}}) + "\n")
+                f.flush()
+                assert _records(f) == [0, 1, 2, 3, 4]
+    finally:
+        stopped.set()
+        thread.join()
+    assert not os.path.exists(path)
@@ -0,0 +1,910 @@
+import concurrent.futures
+import contextlib
+import copy
+import datetime
+import decimal
+import io
+import itertools
+import json
+import operator
+import re
+import threading
+import mock
+import pytest
+from singer import metadata
+from singer.catalog import Catalog, CatalogEntry
+from singer.schema import Schema
+import tap_db2.export as export
+import tap_db2.output as output
+import tap_db2.sync as s
+import tap_db2.timings as timings
+
+
+class FakeCursor(object):
+    """Serves the rows of whichever table was last SELECTed from."""
+    def __init__(self, rows_by_table):
+        self.rows_by_table = rows_by_table
+        self.rows = iter([])
+        self.executed = []
+        self.arraysize = 1
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+        table = sql.split(" FROM ")[1].split(".")[1].split(" ")[0]
+        self.rows = iter(self.rows_by_table[table.strip('"')])
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self.rows, size or self.arraysize))
+
+
+def _fake_get_cursor(rows_by_table, cursor_class=FakeCursor):
+    @contextlib.contextmanager
+    def get_cursor(config):
+        yield cursor_class(rows_by_table)
+    return get_cursor
+
+
+class KeysetCursor(FakeCursor):
+    """Serves pages of rows keyed by their first (integer) column."""
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+        table = sql.split(" FROM ")[1].split(".")[1].split(" ")[0]
+        rows = self.rows_by_table[table.strip('"')]
+        if params:
+            rows = [r for r in rows if r[0] > params[0]]
+        page_size = int(sql.split("FETCH FIRST ")[1].split(" ")[0])
+        self.rows = iter(rows[:page_size])
+
+
+class PartitionCursor(FakeCursor):
+    """Serves a single table keyed by its first (integer) column, evaluating
+    the simple range predicates the partitioned sync generates."""
+    OPS = {">=": operator.ge, "<": operator.lt, ">": operator.gt,
+           "<=": operator.le}
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+        rows = list(self.rows_by_table.values())[0]
+        if sql.startswith("SELECT MIN(RRN(T))"):
+            self.rows = iter([(1, len(rows))])
+            return
+        if sql.startswith("SELECT MIN("):
+            self.rows = iter([(rows[0][0], rows[-1][0])])
+            return
+        if "RRN(T)" in sql:
+            rows = [r + (i + 1,) for i, r in enumerate(rows)]
+            key = -1
+        else:
+            key = 0
+        for op, param in zip(re.findall(r'(?:"id"|RRN\(T\)) (>=|<=|<|>) \?',
+                                        sql),
+                             params):
+            rows = [r for r in rows if self.OPS[op](r[key], param)]
+        page_size = int(sql.split("FETCH FIRST ")[1].split(" ")[0])
+        self.rows = iter(rows[:page_size])
+
+    def fetchone(self):
+        return next(self.rows)
+
+
+def _entry(table, columns, replication_key=None, key_properties=()):
+    mdata = {(): {"selected": True,
+                  "table-key-properties": list(key_properties)}}
+    if replication_key:
+        mdata[()]["replication-key"] = replication_key
+    for column, sql_type in columns.items():
+        mdata[("properties", column)] = {"sql-datatype": sql_type}
+    properties = {c: Schema(type=["null", "integer"], inclusion="available")
+                  for c in columns}
+    return CatalogEntry(tap_stream_id="a_schema-" + table,
+                        stream=table,
+                        database="a_schema",
+                        table=table,
+                        schema=Schema(type="object", properties=properties),
+                        metadata=metadata.to_list(mdata))
+
+
+def _run_sync(config, state, catalog, rows_by_table, cursor_class=FakeCursor):
+    out = io.StringIO()
+    with mock.patch("tap_db2.sync.get_cursor",
+                    _fake_get_cursor(rows_by_table, cursor_class)):
+        output.set_writer(output.MessageWriter(out))
+        try:
+            s.sync(config, state, catalog)
+        finally:
+            output.set_writer(output.MessageWriter())
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_parallel_sync_keeps_per_stream_order():
+    tables = ["t{}".format(i) for i in range(4)]
+    catalog = Catalog([_entry(t, {"id": "integer"}, replication_key="id")
+                       for t in tables])
+    state = {"bookmarks": {"a_schema-" + t: {"replication_key": "id"}
+                           for t in tables}}
+    rows = {t: [(i,) for i in range(2500)] for t in tables}
+    messages = _run_sync({"max_parallel_streams": 4}, state, catalog, rows)
+
+    for table in tables:
+        ids = [m["record"]["id"] for m in messages
+               if m["type"] == "RECORD" and m["stream"] == table]
+        assert ids == list(range(2500))
+    final_state = messages[-1]
+    assert final_state["type"] == "STATE"
+    assert final_state["value"]["currently_syncing"] is None
+    for table in tables:
+        bookmark = final_state["value"]["bookmarks"]["a_schema-" + table]
+        assert bookmark["replication_key_value"] == 2499
+
+
+def test_parallel_state_never_ahead_of_records():
+    tables = ["t{}".format(i) for i in range(3)]
+    catalog = Catalog([_entry(t, {"id": "integer"}, replication_key="id")
+                       for t in tables])
+    state = {"bookmarks": {"a_schema-" + t: {"replication_key": "id"}
+                           for t in tables}}
+    rows = {t: [(i,) for i in range(3000)] for t in tables}
+    messages = _run_sync({"max_parallel_streams": 3}, state, catalog, rows)
+
+    emitted = {}
+    for message in messages:
+        if message["type"] == "RECORD":
+            emitted[message["stream"]] = message["record"]["id"]
+        elif message["type"] == "STATE":
+            for table in tables:
+                bookmark = message["value"]["bookmarks"]["a_schema-" + table]
+                value = bookmark.get("replication_key_value")
+                if value is not None:
+                    assert value <= emitted[table]
+
+
+def test_encode_workers_write_the_same_records_in_order():
+    def run(config):
+        tables = ["t0", "t1"]
+        catalog = Catalog([_entry(t, {"id": "integer", "ts": "timestmp"},
+                                  replication_key="id")
+                           for t in tables])
+        state = {"bookmarks": {"a_schema-" + t: {"replication_key": "id",
+                                                 "version": 1}
+                               for t in tables}}
+        rows = {t: [(i, datetime.datetime(2020, 1, 1, 0, 0, i % 60))
+                    for i in range(3000)] for t in tables}
+        return _run_sync(dict(config, fetch_memory_budget_mb=0.01,
+                              max_parallel_streams=2), state, catalog, rows)
+
+    expected = run({})
+    messages = run({"encode_workers": 2})
+    for table in ["t0", "t1"]:
+        assert ([m for m in messages if m.get("stream") == table]
+                == [m for m in expected if m.get("stream") == table])
+    emitted = {}
+    for message in messages:
+        if message["type"] == "RECORD":
+            emitted[message["stream"]] = message["record"]["id"]
+        elif message["type"] == "STATE":
+            for table, bookmark in message["value"]["bookmarks"].items():
+                value = bookmark.get("replication_key_value")
+                if value is not None:
+                    assert value <= emitted[table.split("-")[1]]
+    assert messages[-1]["value"]["bookmarks"]["a_schema-t0"][
+        "replication_key_value"] == 2999
+
+
+def test_fetch_batch_size_respects_memory_budget():
+    narrow = _entry("narrow", {"id": "integer"})
+    wide = _entry("wide", {"c{}".format(i): "varchar" for i in range(200)})
+    for prop in wide.schema.properties.values():
+        prop.maxLength = 1000
+    config = {"fetch_memory_budget_mb": 1}
+    narrow_width = s._estimate_row_width(narrow, ["id"])
+    wide_width = s._estimate_row_width(wide, list(wide.schema.properties))
+    assert s._fetch_batch_size(config, narrow_width) == 1024 * 1024 // narrow_width
+    assert s._fetch_batch_size(config, wide_width) == 1024 * 1024 // wide_width
+    assert s._fetch_batch_size(config, 1) == s.MAX_FETCH_BATCH_SIZE
+    assert s._fetch_batch_size(config, 10 ** 9) == 1
+
+
+def test_fetch_batches_yields_every_row():
+    entry = _entry("t", {"id": "integer"})
+    cursor = FakeCursor({"t": [(i,) for i in range(1234)]})
+    cursor.execute('SELECT "id" FROM "a_schema"."t"')
+    config = {"fetch_memory_budget_mb": 0.01}
+    batches = list(s._fetch_batches(config, cursor, entry, ["id"]))
+    assert len(batches) > 1
+    assert [r for b in batches for r in b] == [(i,) for i in range(1234)]
+
+
+def test_prefetched_batches_match_direct_fetch():
+    entry = _entry("t", {"id": "integer"})
+    cursor = FakeCursor({"t": [(i,) for i in range(1234)]})
+    cursor.execute('SELECT "id" FROM "a_schema"."t"')
+    config = {"fetch_memory_budget_mb": 0.01, "fetch_queue_depth": 2}
+    batches = list(s._fetch_batches(config, cursor, entry, ["id"]))
+    assert len(batches) > 2
+    assert [r for b in batches for r in b] == [(i,) for i in range(1234)]
+
+
+def test_prefetch_raises_fetch_errors_and_stops_on_early_exit():
+    def failing():
+        yield [1]
+        raise ValueError("lost connection")
+    batches = s._prefetch(failing(), 1)
+    assert next(batches) == [1]
+    with pytest.raises(ValueError):
+        next(batches)
+
+    fetched = []
+    def endless():
+        for i in itertools.count():
+            fetched.append(i)
+            yield [i]
+    batches = s._prefetch(endless(), 2)
+    assert next(batches) == [0]
+    batches.close()
+    count = len(fetched)
+    assert count <= 4
+    assert len(fetched) == count
+
+
+def test_prefetch_stops_when_writing_rows_fails():
+    entry = _entry("t", {"id": "integer"})
+    cursor = FakeCursor({"t": [(i,) for i in range(1234)]})
+    cursor.execute('SELECT "id" FROM "a_schema"."t"')
+    config = {"fetch_memory_budget_mb": 0.01, "fetch_queue_depth": 2}
+    timings.start(entry)
+    threads = threading.active_count()
+    with mock.patch("tap_db2.output.write_line",
+                    side_effect=IOError("broken pipe")):
+        with pytest.raises(IOError):
+            s._sync_rows(config, {}, cursor, entry, ["id"], [], 1,
+                         lambda state, record, row: None)
+    # The fetching thread is done with the cursor before the error is seen.
+    assert threading.active_count() == threads
+
+
+def test_row_to_record_converts_only_temporal_columns():
+    columns = {"i": "integer", "d": "decimal", "s": "varchar",
+               "ts": "timestmp", "dt": "date", "tm": "time", "x": None}
+    entry = _entry("t", columns)
+    names = list(columns)
+    converters = s._compile_converters(entry, names)
+    assert [i for i, _ in converters] == [3, 4, 5, 6]
+    row = (1, decimal.Decimal("1.50"), "abc",
+           datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+           datetime.date(2020, 1, 2),
+           datetime.time(3, 4, 5),
+           datetime.date(2021, 2, 3))
+    record = s._row_to_record(row, names, converters)
+    assert record == {"i": 1,
+                      "d": decimal.Decimal("1.50"),
+                      "s": "abc",
+                      "ts": "2020-01-02T03:04:05.000006+00:00",
+                      "dt": "2020-01-02T00:00:00+00:00",
+                      "tm": "1970-01-01T03:04:05+00:00",
+                      "x": "2021-02-03T00:00:00+00:00"}
+    nulls = s._row_to_record((None,) * 7, names, converters)
+    assert nulls == {c: None for c in names}
+
+
+def test_full_table_sync_reads_keyset_pages():
+    catalog = Catalog([_entry("t", {"id": "integer"}, key_properties=["id"])])
+    rows = {"t": [(i,) for i in range(250)]}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        messages = _run_sync({"full_table_page_size": 100}, {}, catalog, rows,
+                             KeysetCursor)
+    queries = [c[0][2] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    assert queries == [(), (99,), (199,)]
+    ids = [m["record"]["id"] for m in messages if m["type"] == "RECORD"]
+    assert ids == list(range(250))
+
+
+def test_full_table_sync_resumes_from_last_pk():
+    catalog = Catalog([_entry("t", {"id": "integer"}, key_properties=["id"])])
+    state = {"bookmarks": {"a_schema-t": {"version": 42,
+                                          "last_pk_fetched": {"id": 149}}}}
+    rows = {"t": [(i,) for i in range(250)]}
+    messages = _run_sync({"full_table_page_size": 100}, state, catalog, rows,
+                         KeysetCursor)
+    records = [m for m in messages if m["type"] == "RECORD"]
+    assert [m["record"]["id"] for m in records] == list(range(150, 250))
+    assert {m["version"] for m in records} == {42}
+    activate = [m for m in messages if m["type"] == "ACTIVATE_VERSION"]
+    assert activate[-1]["version"] == 42
+    final_bookmark = messages[-1]["value"]["bookmarks"]["a_schema-t"]
+    assert final_bookmark == {"version": None}
+
+
+def test_views_are_not_paged_by_view_key_properties():
+    entry = _entry("v", {"id": "integer"})
+    entry.is_view = True
+    mdata = metadata.to_map(entry.metadata)
+    mdata[()]["view-key-properties"] = ["id"]
+    entry.metadata = metadata.to_list(mdata)
+    catalog = Catalog([entry])
+    # The declared view key isn't unique.
+    rows = {"v": [(i // 2,) for i in range(250)]}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        messages = _run_sync({"full_table_page_size": 100,
+                              "table_partitions": 4}, {}, catalog, rows)
+    queries = [c[0][1] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    assert len(queries) == 1
+    assert "FETCH FIRST" not in queries[0]
+    ids = [m["record"]["id"] for m in messages if m["type"] == "RECORD"]
+    assert ids == [i // 2 for i in range(250)]
+
+
+def test_partitioned_sync_by_key_range():
+    catalog = Catalog([_entry("t", {"id": "integer"}, key_properties=["id"])])
+    rows = {"t": [(i,) for i in range(1000)]}
+    messages = _run_sync({"table_partitions": 4, "full_table_page_size": 100},
+                         {}, catalog, rows, PartitionCursor)
+    records = [m for m in messages if m["type"] == "RECORD"]
+    assert sorted(m["record"]["id"] for m in records) == list(range(1000))
+    assert len({m["version"] for m in records}) == 1
+    partitions = [m["value"].get("bookmarks", {}).get("a_schema-t", {})
+                  .get("partitions")
+                  for m in messages if m["type"] == "STATE"]
+    plan = [p for p in partitions if p][0]
+    assert [(p["lower"], p["upper"]) for p in plan] == [
+        (None, 249), (249, 498), (498, 747), (747, None)]
+    activates = [i for i, m in enumerate(messages)
+                 if m["type"] == "ACTIVATE_VERSION"]
+    assert activates[-1] > max(i for i, m in enumerate(messages)
+                               if m["type"] == "RECORD")
+    assert messages[-1]["value"]["bookmarks"]["a_schema-t"] == {
+        "version": None}
+
+
+def test_partitioned_sync_resumes_by_rrn():
+    catalog = Catalog([_entry("t", {"id": "integer"})])
+    rows = {"t": [(i,) for i in range(100)]}
+    state = {"bookmarks": {"a_schema-t": {"version": 7, "partitions": [
+        {"lower": 1, "upper": 50, "done": True},
+        {"lower": 51, "upper": 100, "last_rrn": 80, "done": False}]}}}
+    messages = _run_sync({"table_partitions": 2, "full_table_page_size": 7},
+                         state, catalog, rows, PartitionCursor)
+    records = [m for m in messages if m["type"] == "RECORD"]
+    assert [m["record"]["id"] for m in records] == list(range(80, 100))
+    assert {m["version"] for m in records} == {7}
+
+
+def _incremental_states(config, ids):
+    catalog = Catalog([_entry("t", {"id": "integer"}, replication_key="id")])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "id",
+                                          "version": 1}}}
+    rows = {"t": [(i,) for i in ids]}
+    messages = _run_sync(config, state, catalog, rows)
+    last_id = None
+    states = []
+    for message in messages:
+        if message["type"] == "RECORD":
+            last_id = message["record"]["id"]
+        elif message["type"] == "STATE" and last_id is not None:
+            bookmark = message["value"]["bookmarks"]["a_schema-t"]
+            assert bookmark["replication_key_value"] == last_id
+            states.append(last_id)
+    return states
+
+
+def test_checkpoint_by_rows():
+    states = _incremental_states({"checkpoint_interval_rows": 100}, range(350))
+    assert states == [99, 199, 299, 349, 349]
+
+
+def test_checkpoint_by_bytes():
+    # Each RECORD line is the same length, so this checkpoints every 10 rows.
+    line = len(json.dumps({"type": "RECORD", "stream": "t",
+                           "record": {"id": 100}, "version": 1}) + "\n")
+    states = _incremental_states({"checkpoint_interval_rows": 0,
+                                  "checkpoint_interval_bytes": line * 10},
+                                 range(100, 135))
+    assert states == [109, 119, 129, 134, 134]
+
+
+def test_checkpoint_by_seconds():
+    with mock.patch("tap_db2.sync.monotonic") as monotonic:
+        monotonic.side_effect = itertools.count()
+        states = _incremental_states({"checkpoint_interval_rows": 0,
+                                      "checkpoint_interval_seconds": 5},
+                                     range(12))
+    assert states == [4, 9, 11, 11]
+
+
+def test_stage_timings_are_reported(tmpdir):
+    catalog = Catalog([_entry("t", {"id": "integer"}, key_properties=["id"])])
+    rows = {"t": [(i,) for i in range(250)]}
+    metrics_file = str(tmpdir.join("tap.prom"))
+    with mock.patch("tap_db2.timings.LOGGER") as logger:
+        _run_sync({"full_table_page_size": 100, "metrics_file": metrics_file},
+                  {}, catalog, rows, KeysetCursor)
+    points = [json.loads(c[0][1]) for c in logger.info.call_args_list
+              if c[0][0].startswith("METRIC")]
+    stages = [p["tags"]["stage"] for p in points
+              if p["metric"] == "sync_stage_duration"]
+    assert stages == ["execute", "fetch", "convert", "encode", "write"]
+    assert [p["metric"] for p in points][-1] == "time_to_first_row"
+    with open(metrics_file) as f:
+        text = f.read()
+    assert ('tap_db2_stage_seconds_total{schema="a_schema",table="t",'
+            'stage="fetch"}') in text
+    assert 'tap_db2_rows_total{schema="a_schema",table="t"} 250' in text
+
+
+def test_metrics_file_written_from_many_threads(tmpdir):
+    config = {"metrics_file": str(tmpdir.join("tap.prom"))}
+
+    def write():
+        for _ in range(20):
+            timings.write_metrics_file(config)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        for future in [pool.submit(write) for _ in range(4)]:
+            future.result()
+    assert tmpdir.listdir() == [tmpdir.join("tap.prom")]
+
+
+def _row_image(id_, name, amount, updated):
+    return (id_.to_bytes(4, "big", signed=True)
+            + len(name).to_bytes(2, "big")
+            + name.encode("cp037").ljust(10, b"\x40")
+            + bytes.fromhex(amount)
+            + updated.encode("cp037"))
+
+
+class JournalCursor(KeysetCursor):
+    """Serves the catalog and journal queries of LOG_BASED replication, and
+    the table itself for the initial full table sync."""
+    LAYOUT = [("id", "INTEGER", 4, 0, None),
+              ("name", "VARCHAR", 12, None, 37),
+              ("amount", "DECIMAL", 3, 2, None),
+              ("updated", "TIMESTMP", 26, None, 37)]
+    ENTRIES = [
+        ("PT", datetime.datetime(2020, 1, 2, 3, 0), 11, "000000",
+         _row_image(3, "new", "00100c", "2020-01-02-03.00.00.000000")),
+        ("UB", datetime.datetime(2020, 1, 2, 4, 0), 12, "000000",
+         _row_image(1, "one", "00100c", "2020-01-01-00.00.00.000000")),
+        ("UP", datetime.datetime(2020, 1, 2, 4, 0), 13, "0100",
+         _row_image(1, "uno", "12345d", "2020-01-02-04.00.00.500000")),
+        ("DL", datetime.datetime(2020, 1, 2, 5, 0), 14, "000000",
+         _row_image(2, "two", "00200c", "2020-01-01-00.00.00.000000")),
+    ]
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+        if "object_statistics" in sql:
+            self.rows = iter([("JRNLIB    ", "QSQJRN    ", "LIB", "T")])
+        elif "MAX(sequence_number)" in sql:
+            self.rows = iter([(decimal.Decimal(10),)])
+        elif sql.startswith("SELECT CURRENT TIMEZONE"):
+            self.rows = iter([(decimal.Decimal(10000),)])
+        elif "syscolumns" in sql:
+            self.rows = iter(self.LAYOUT)
+        elif "display_journal" in sql:
+            assert "'DL,DR,PT,PX,UP,UR'" in sql
+            self.rows = iter([(t, ts, image, nulls, seq)
+                              for t, ts, seq, nulls, image in self.ENTRIES
+                              if seq >= params[2] and t != "UB"])
+        else:
+            super().execute(sql, params)
+
+    def fetchone(self):
+        return next(self.rows)
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+def _log_based_entry():
+    entry = _entry("t", {"id": "integer", "name": "varchar",
+                         "amount": "decimal", "updated": "timestmp"},
+                   key_properties=["id"])
+    entry.metadata = metadata.to_list(metadata.write(
+        metadata.to_map(entry.metadata), (), "replication-method",
+        "LOG_BASED"))
+    return entry
+
+
+def test_log_based_sync_runs_initial_full_table_then_reads_journal():
+    catalog = Catalog([_log_based_entry()])
+    rows = {"t": [(1, "one", decimal.Decimal("1.00"),
+                   datetime.datetime(2020, 1, 1)),
+                  (2, "two", decimal.Decimal("2.00"),
+                   datetime.datetime(2020, 1, 1))]}
+    messages = _run_sync({}, {}, catalog, rows, JournalCursor)
+    schema = messages[1]["schema"]
+    assert schema["properties"]["_sdc_deleted_at"]["format"] == "date-time"
+    records = [m["record"] for m in messages if m["type"] == "RECORD"]
+    assert [r["id"] for r in records[:2]] == [1, 2]
+    assert records[2:] == [
+        {"id": 3, "name": "new", "amount": 1.0,
+         "updated": "2020-01-02T02:00:00+00:00", "_sdc_deleted_at": None},
+        {"id": 1, "name": None, "amount": -123.45,
+         "updated": "2020-01-02T03:00:00.500000+00:00",
+         "_sdc_deleted_at": None},
+        {"id": 2, "name": "two", "amount": 2.0,
+         "updated": "2019-12-31T23:00:00+00:00",
+         "_sdc_deleted_at": "2020-01-02T04:00:00+00:00"},
+    ]
+    activate = [i for i, m in enumerate(messages)
+                if m["type"] == "ACTIVATE_VERSION"]
+    assert len(activate) == 1
+    bookmark = messages[-1]["value"]["bookmarks"]["a_schema-t"]
+    assert bookmark["journal_sequence"] == 14
+    assert bookmark["initial_full_table_complete"] is True
+    assert bookmark["version"] is not None
+
+
+def test_log_based_sync_resumes_from_journal_sequence():
+    catalog = Catalog([_log_based_entry()])
+    state = {"bookmarks": {"a_schema-t": {
+        "version": 5, "journal_sequence": 13,
+        "initial_full_table_complete": True}}}
+    messages = _run_sync({}, state, catalog, {"t": []}, JournalCursor)
+    records = [m for m in messages if m["type"] == "RECORD"]
+    assert [(m["record"]["id"], m["version"]) for m in records] == [(2, 5)]
+    assert not [m for m in messages if m["type"] == "ACTIVATE_VERSION"]
+    assert messages[-1]["value"]["bookmarks"]["a_schema-t"][
+        "journal_sequence"] == 14
+
+
+class WindowCursor(PartitionCursor):
+    """Serves a table keyed by its first column, evaluating the range
+    predicates of windowed incremental queries."""
+    def execute(self, sql, params=()):
+        if "FETCH FIRST" in sql:
+            return super().execute(sql, params)
+        self.executed.append((sql, params))
+        rows = list(self.rows_by_table.values())[0]
+        if " IS NULL" in sql:
+            self.rows = iter([r for r in rows if r[0] is None])
+            return
+        rows = [r for r in rows if r[0] is not None]
+        if sql.startswith("SELECT MIN("):
+            keys = [r[0] for r in rows]
+            self.rows = iter([(min(keys, default=None),
+                               max(keys, default=None))])
+            return
+        for op, param in zip(re.findall(r'"id" (>=|<=|<|>) \?', sql), params):
+            rows = [r for r in rows if self.OPS[op](r[0], param)]
+        self.rows = iter(rows)
+
+
+def test_incremental_sync_in_adaptive_windows():
+    catalog = Catalog([_entry("t", {"id": "integer"}, replication_key="id")])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "id",
+                                          "replication_key_value": 100,
+                                          "version": 1}}}
+    # A dense run of keys between sparse ones.
+    ids = (list(range(0, 10000, 100)) + list(range(10000, 20000))
+           + list(range(20000, 200000, 100)))
+    rows = {"t": [(i,) for i in ids]}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        messages = _run_sync({"incremental_window_rows": 200}, state,
+                             catalog, rows, WindowCursor)
+    windows = [c[0][2] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    # The first window is a hundredth of the way to the maximum key.
+    assert windows[0] == (100, 100 + (199900 - 100) // 100)
+    assert windows[-1][1] == 199900
+    assert all(a[1] == b[0] for a, b in zip(windows, windows[1:]))
+    # Windows grow while rows are sparse and shrink on reaching dense ones.
+    widths = [end - start for start, end in windows[:-1]]
+    assert widths[1] > widths[0]
+    assert any(b < a for a, b in zip(widths, widths[1:]))
+    records = [m["record"]["id"] for m in messages if m["type"] == "RECORD"]
+    assert records == [i for i in ids if i >= 100]
+    states = [m for m in messages if m["type"] == "STATE"]
+    assert len(states) > len(windows)
+    assert states[-1]["value"]["bookmarks"]["a_schema-t"][
+        "replication_key_value"] == 199900
+
+
+def test_first_windowed_sync_includes_null_keys():
+    catalog = Catalog([_entry("t", {"id": "integer"}, replication_key="id")])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "id",
+                                          "version": 1}}}
+    rows = {"t": [(None,)] + [(i,) for i in range(500)] + [(None,)]}
+    messages = _run_sync({"incremental_window_rows": 100},
+                         copy.deepcopy(state), catalog, rows, WindowCursor)
+    records = [m["record"]["id"] for m in messages if m["type"] == "RECORD"]
+    assert records == list(range(500)) + [None, None]
+    assert messages[-1]["value"]["bookmarks"]["a_schema-t"][
+        "replication_key_value"] == 499
+    # Tables holding nothing but NULL keys have no windows at all.
+    messages = _run_sync({"incremental_window_rows": 100},
+                         copy.deepcopy(state), catalog, {"t": [(None,)]},
+                         WindowCursor)
+    assert [m["record"] for m in messages if m["type"] == "RECORD"] == [
+        {"id": None}]
+
+
+def test_incremental_bookmark_resumes_strictly_after_last_row():
+    entry = _entry("t", {"id": "integer", "updated": "integer"},
+                   replication_key="updated", key_properties=["id"])
+    catalog = Catalog([entry])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "updated",
+                                          "version": 1}}}
+    rows = {"t": [(1, 10), (2, 10), (3, 20)]}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        messages = _run_sync({}, state, catalog, rows)
+        bookmark = messages[-1]["value"]["bookmarks"]["a_schema-t"]
+        assert bookmark["replication_key_value"] == 20
+        assert bookmark["replication_key_pk"] == {"id": 3}
+        _run_sync({}, messages[-1]["value"], catalog, rows)
+    queries = [c[0][1:] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    assert queries[0] == (
+        'SELECT "id","updated" FROM "a_schema"."t"'
+        ' ORDER BY "updated" ASC, "id" ASC', ())
+    assert queries[1] == (
+        'SELECT "id","updated" FROM "a_schema"."t"'
+        ' WHERE (("updated" > ?) OR ("updated" = ? AND "id" > ?))'
+        ' ORDER BY "updated" ASC, "id" ASC', (20, 20, 3))
+
+
+def test_decimal_replication_key_round_trips_exactly():
+    catalog = Catalog([_entry("t", {"amount": "decimal"},
+                              replication_key="amount")])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "amount",
+                                          "version": 1}}}
+    rows = {"t": [(decimal.Decimal("12345.67"),)]}
+    messages = _run_sync({}, state, catalog, rows)
+    saved = json.loads(json.dumps(messages[-1]["value"]))
+    assert saved["bookmarks"]["a_schema-t"][
+        "replication_key_value"] == "12345.67"
+    # Bookmarks written as floats are read back exactly too.
+    old = copy.deepcopy(saved)
+    old["bookmarks"]["a_schema-t"]["replication_key_value"] = 12345.67
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        _run_sync({}, saved, catalog, rows)
+        _run_sync({"incremental_window_rows": 100}, old, catalog, rows,
+                  WindowCursor)
+    params = [c[0][2] for c in logger.info.call_args_list
+              if c[0][0].startswith("Running")]
+    assert params[0] == (decimal.Decimal("12345.67"),)
+    assert str(params[1][0]) == "12345.67"
+
+
+def test_incremental_views_resume_inclusively():
+    entry = _entry("v", {"k": "integer", "u": "integer"},
+                   replication_key="u")
+    entry.is_view = True
+    mdata = metadata.to_map(entry.metadata)
+    mdata[()]["view-key-properties"] = ["k"]
+    entry.metadata = metadata.to_list(mdata)
+    catalog = Catalog([entry])
+    state = {"bookmarks": {"a_schema-v": {"replication_key": "u",
+                                          "version": 1}}}
+    # The declared view key isn't unique.
+    rows = {"v": [(1, 10), (1, 10), (2, 20)]}
+    messages = _run_sync({"checkpoint_interval_rows": 1}, state, catalog,
+                         rows)
+    first_checkpoint = [m["value"] for m in messages
+                        if m["type"] == "STATE"][1]
+    bookmark = first_checkpoint["bookmarks"]["a_schema-v"]
+    assert bookmark["replication_key_value"] == 10
+    assert "replication_key_pk" not in bookmark
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        _run_sync({}, first_checkpoint, catalog, rows)
+    queries = [c[0][1:] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    assert queries == [('SELECT "k","u" FROM "a_schema"."v"'
+                        ' WHERE "u" >= ? ORDER BY "u" ASC', (10,))]
+
+
+def test_incremental_bookmark_without_primary_key_is_inclusive():
+    catalog = Catalog([_entry("t", {"updated": "integer"},
+                              replication_key="updated")])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "updated",
+                                          "replication_key_value": 20,
+                                          "version": 1}}}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        messages = _run_sync({}, state, catalog, {"t": [(20,)]})
+    queries = [c[0][1:] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    assert queries == [('SELECT "updated" FROM "a_schema"."t"'
+                        ' WHERE "updated" >= ? ORDER BY "updated" ASC',
+                        (20,))]
+    assert "replication_key_pk" not in messages[-1]["value"]["bookmarks"][
+        "a_schema-t"]
+
+
+def test_query_hints_from_config_and_stream_metadata():
+    plain = _entry("plain", {"id": "integer"}, key_properties=["id"])
+    hinted = _entry("hinted", {"id": "integer"}, key_properties=["id"])
+    hinted.metadata = metadata.to_list(metadata.write(
+        metadata.to_map(hinted.metadata), (), "isolation-level", "cs"))
+    catalog = Catalog([plain, hinted])
+    rows = {"plain": [(1,)], "hinted": [(1,)]}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        _run_sync({"isolation_level": "UR", "optimize_for_rows": 500}, {},
+                  catalog, rows, KeysetCursor)
+    queries = [c[0][1] for c in logger.info.call_args_list
+               if c[0][0].startswith("Running")]
+    assert queries[0].endswith(
+        "FETCH FIRST 100000 ROWS ONLY OPTIMIZE FOR 500 ROWS WITH UR")
+    assert queries[1].endswith("OPTIMIZE FOR 500 ROWS WITH CS")
+
+
+def test_unknown_isolation_level_is_rejected():
+    entry = _entry("t", {"id": "integer"})
+    with pytest.raises(Exception, match="Unknown isolation level DIRTY"):
+        s._stream_config({"isolation_level": "dirty"}, entry)
+
+
+def test_server_temporal_formatting():
+    entry = _entry("t", {"ts": "timestmp", "d": "date", "t": "time",
+                         "n": "integer"}, key_properties=["ts"])
+    for column in ("ts", "d", "t"):
+        entry.schema.properties[column].format = "date-time"
+    columns = ["ts", "d", "t", "n"]
+    select = s._select_sql(entry, columns, server_format=True)
+    assert select == (
+        'SELECT REPLACE(CASE WHEN MICROSECOND("ts" - CURRENT TIMEZONE) = 0'
+        ' THEN VARCHAR_FORMAT("ts" - CURRENT TIMEZONE,'
+        ' \'YYYY-MM-DD HH24:MI:SS\')'
+        ' ELSE VARCHAR_FORMAT("ts" - CURRENT TIMEZONE,'
+        ' \'YYYY-MM-DD HH24:MI:SS.NNNNNN\') END, \' \', \'T\') || \'+00:00\','
+        'CHAR("d", ISO) || \'T00:00:00+00:00\','
+        '\'1970-01-01T\' || CHAR("t", JIS) || \'+00:00\','
+        '"n" FROM "a_schema"."t"')
+    assert s._compile_converters(entry, columns, server_format=True) == []
+
+    class PagedCursor(FakeCursor):
+        def execute(self, sql, params=()):
+            super().execute(sql, params)
+            if len(self.executed) > 1:
+                self.rows = iter([])
+
+    rows = {"t": [("2020-01-01T00:00:00+00:00", "2020-01-01T00:00:00+00:00",
+                   "1970-01-01T12:00:00+00:00", 1)]}
+    with mock.patch("tap_db2.sync.LOGGER") as logger:
+        messages = _run_sync({"server_temporal_formatting": True,
+                              "full_table_page_size": 1},
+                             {}, Catalog([entry]), rows, PagedCursor)
+    params = [c[0][2] for c in logger.info.call_args_list
+              if c[0][0].startswith("Running")]
+    assert params[1] == (datetime.datetime(2020, 1, 1,
+                                           tzinfo=params[1][0].tzinfo),)
+    records = [m["record"] for m in messages if m["type"] == "RECORD"]
+    assert records == [{"ts": "2020-01-01T00:00:00+00:00",
+                        "d": "2020-01-01T00:00:00+00:00",
+                        "t": "1970-01-01T12:00:00+00:00", "n": 1}]
+
+
+def test_export_writes_files_and_bookmarks_closed_files_only(tmpdir):
+    pyarrow = pytest.importorskip("pyarrow")
+    entry = _entry("t", {"id": "integer", "amount": "decimal",
+                         "updated": "timestmp"},
+                   replication_key="updated", key_properties=["id"])
+    entry.schema.properties["amount"] = Schema(
+        type=["null", "number"], multipleOf=0.01, maximum=1000)
+    catalog = Catalog([entry])
+    state = {"bookmarks": {"a_schema-t": {"replication_key": "updated",
+                                          "version": 1}}}
+    rows = {"t": [(i, decimal.Decimal("1.50"),
+                   datetime.datetime(2020, 1, 1, 0, 0, i)) for i in range(50)]}
+    config = {"export_format": "arrow", "export_dir": str(tmpdir),
+              "export_file_size_mb": 0.001, "fetch_memory_budget_mb": 0.002}
+    messages = _run_sync(config, state, catalog, rows)
+    assert not [m for m in messages if m["type"] == "RECORD"]
+    files = sorted(tmpdir.join("a_schema-t").listdir())
+    assert len(files) > 1
+    tables = [pyarrow.ipc.open_file(str(f)).read_all() for f in files]
+    assert str(tables[0].schema.field("amount").type) == "decimal128(5, 2)"
+    ids = [i for table in tables for i in table.column("id").to_pylist()]
+    assert ids == list(range(50))
+    # Every STATE message points at the last row of a closed file.
+    ends = set()
+    total = 0
+    for table in tables:
+        total += table.num_rows
+        ends.add("2020-01-01T00:00:{:02d}+00:00".format(total - 1))
+    bookmarks = [m["value"]["bookmarks"]["a_schema-t"].get(
+        "replication_key_value") for m in messages if m["type"] == "STATE"]
+    assert {b for b in bookmarks if b} <= ends
+    assert bookmarks[-1] == "2020-01-01T00:00:49+00:00"
+
+
+def test_export_writes_decfloats_as_doubles(tmpdir):
+    pyarrow = pytest.importorskip("pyarrow")
+    catalog = Catalog([_entry("t", {"id": "integer", "x": "decfloat"},
+                              key_properties=["id"])])
+    rows = {"t": [(1, decimal.Decimal("1.25")), (2, None)]}
+    config = {"export_format": "parquet", "export_dir": str(tmpdir)}
+    _run_sync(config, {}, catalog, rows)
+    [path] = tmpdir.join("a_schema-t").listdir()
+    table = pyarrow.parquet.read_table(str(path))
+    assert str(table.schema.field("x").type) == "double"
+    assert table.column("x").to_pylist() == [1.25, None]
+
+
+def test_export_runs_from_the_same_state_keep_earlier_files(tmpdir):
+    pytest.importorskip("pyarrow")
+    catalog = Catalog([_entry("t", {"id": "integer"}, key_properties=["id"])])
+    state = {"bookmarks": {"a_schema-t": {"version": 1}}}
+    rows = {"t": [(i,) for i in range(50)]}
+    config = {"export_format": "arrow", "export_dir": str(tmpdir),
+              "export_file_size_mb": 0.001, "fetch_memory_budget_mb": 0.002}
+    _run_sync(config, copy.deepcopy(state), catalog, rows)
+    first = {f.basename: f.read_binary()
+             for f in tmpdir.join("a_schema-t").listdir()}
+    # A new process starts numbering parts over.
+    export._PARTS.clear()
+    _run_sync(config, copy.deepcopy(state), catalog, rows)
+    files = {f.basename: f.read_binary()
+             for f in tmpdir.join("a_schema-t").listdir()}
+    assert len(files) == 2 * len(first)
+    assert {name: files[name] for name in first} == first
+
+
+class StatCursor(FakeCursor):
+    """Also serves table statistics, with each table's row count as its
+    estimate."""
+    def execute(self, sql, params=()):
+        if "systablestat" in sql:
+            self.executed.append((sql, params))
+            self.rows = iter([("a_schema  ", t, len(rows), 100 * len(rows))
+                              for t, rows in self.rows_by_table.items()])
+            return
+        super().execute(sql, params)
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+def test_estimates_bind_schemas_and_pick_selected_tables():
+    entries = [_entry(t, {"id": "integer"}) for t in ("a", "b")]
+    rows = {"a": [(1,)], "b": [(1,), (2,)], "not_selected": [(1,)]}
+    cursors = []
+
+    def get_cursor(config):
+        cursors.append(StatCursor(rows))
+        return contextlib.nullcontext(cursors[-1])
+    with mock.patch("tap_db2.progress.get_cursor", get_cursor):
+        estimates = s.progress.query_estimates({}, entries)
+    assert estimates == {"a_schema-a": s.progress.Estimate(1, 100),
+                         "a_schema-b": s.progress.Estimate(2, 200)}
+    [(sql, params)] = cursors[0].executed
+    assert "table_schema IN (?)" in sql
+    assert params == ["a_schema"]
+
+
+def test_largest_streams_first_with_progress():
+    sizes = {"small": 10, "large": 3000, "medium": 1500, "view": 5}
+    catalog = Catalog([_entry(t, {"id": "integer"}, replication_key="id")
+                       for t in sizes])
+    state = {"currently_syncing": "a_schema-medium",
+             "bookmarks": {"a_schema-" + t: {"replication_key": "id"}
+                           for t in sizes}}
+    state["bookmarks"]["a_schema-medium"]["replication_key_value"] = 1000
+    rows = {t: [(i,) for i in range(n)] for t, n in sizes.items()}
+    config = {"stream_order": "largest_first", "report_progress": True}
+
+    original_query = s.progress.query_estimates
+    def query_estimates(config, entries):
+        # The view has no statistics.
+        return {k: v for k, v in original_query(config, entries).items()
+                if k != "a_schema-view"}
+    with mock.patch("tap_db2.progress.get_cursor",
+                    _fake_get_cursor(rows, StatCursor)), \
+            mock.patch("tap_db2.progress.query_estimates", query_estimates), \
+            mock.patch("tap_db2.progress.LOGGER") as logger:
+        messages = _run_sync(config, state, catalog, rows)
+
+    streams = []
+    for m in messages:
+        if m["type"] == "RECORD" and m["stream"] not in streams:
+            streams.append(m["stream"])
+    assert streams == ["large", "medium", "small", "view"]
+    assert all(m["value"].get("currently_syncing") is None
+               for m in messages if m["type"] == "STATE")
+    lines = [c[0][0] % c[0][1:] for c in logger.info.call_args_list]
+    assert "Progress of a_schema-large: 3000 of ~3000 rows (100.0%)" in \
+        "\n".join(lines)
+    # medium resumes from a bookmark, so its estimate isn't used.
+    assert any(l.startswith("Progress of a_schema-medium: 1500 rows,")
+               for l in lines)
+    assert lines[-1].startswith("Progress of run: 3010 of ~3010 rows (100.0%)")